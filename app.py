@@ -1,16 +1,91 @@
-from flask import Flask, request, render_template, url_for
+import atexit
+import os
+import queue
+import sys
+import threading
+from flask import Flask, Response, g, request, render_template, url_for, jsonify
 from markupsafe import Markup
-from AIandWEB2.index_builder_whoosh import initialize_index, search_index, add_to_index
+
+#the modules of the repo import each other by their plain names (like crwl.py run from the repo), so the
+#app, which is imported as AIandWEB2.app, puts its own directory on the path and imports them the same way.
+#appended, so generic names like metrics or pipeline never shadow installed packages for the whole process
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+if repo_dir not in sys.path:
+    sys.path.append(repo_dir)
+import writer_process
+from metrics import render_prometheus, timed
+#the index modules (whoosh, numpy) are imported by the first request that needs them, not at startup
 
 app = Flask(__name__)
+app.config["PROFILING"] = os.environ.get("SEARCH_PROFILING") == "1"    #allows ?profile=1 on any request, keep it off in production
+app.config["SEARCH_BACKEND"] = os.environ.get("SEARCH_BACKEND", "whoosh")   #"memory" serves searches from memory_index, built from the whoosh index
+
+index_dir = os.environ.get("SEARCH_INDEX_DIR", "index")     #the woosh indx dir
+MAX_PER_PAGE = 50       #upper bound for per_page so a single request can't ask for the whole index
+_index_writer = None
+_index_writer_lock = threading.Lock()
+
+
+def get_index_writer():
+    """
+    writer for the pages posted to /index.
+    under gunicorn (gunicorn.conf.py) it is the writer process shared by all workers, with the dev server
+    an IndexBatchWriter in this process. Both commit in batches, posted pages are searchable after at most 2 sec.
+    """
+    global _index_writer
+    with _index_writer_lock:
+        if _index_writer is None:
+            if writer_process.shared_writer is not None:
+                _index_writer = writer_process.shared_writer
+            else:
+                from index_builder_whoosh import IndexBatchWriter
+                _index_writer = IndexBatchWriter(index_dir, batch_size=100, commit_interval=2.0)
+                atexit.register(_index_writer.close)     #flush the last batch on shutdown
+        return _index_writer
+
+
+def open_index():       #open the index of the search backend now instead of in the first search, gunicorn calls it after forking a worker
+    try:
+        if app.config["SEARCH_BACKEND"] == "memory":
+            from memory_index import get_memory_index
+            get_memory_index(index_dir)
+        else:
+            from index_builder_whoosh import shared_searcher
+            with shared_searcher(index_dir):
+                pass
+    except Exception as e:
+        print(f"Error opening index {index_dir}: {e}")
+
+
+def render(template, **context):      #render_template with the time recorded in the render histogram
+    with timed("render"):
+        return render_template(template, **context)
+
 
-index_dir = "index"     #initialize the woosh indx dir
-initialize_index(index_dir)
+@app.before_request
+def start_profiling():      #with profiling enabled ?profile=1 returns the cProfile stats of the request instead of its response
+    if app.config["PROFILING"] and request.args.get("profile") == "1":
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def stop_profiling(response):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    import io
+    import pstats
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+    return Response(out.getvalue(), mimetype="text/plain")
 
 
 @app.route("/")
 def home():             #Render a search form.
-    return render_template("home.html")
+    return render("home.html")
 
 
 @app.route("/index", methods=["POST"])
@@ -21,25 +96,67 @@ def index():
     if not url or not html:
         return "URL and HTML content are required.", 400
     try:
-        add_to_index(index_dir, url=url, html=html)
+        get_index_writer().add(url, html)
         return f"Indexed: {url}", 200
+    except (writer_process.WriterUnavailable, queue.Full) as e:      #the writer process is being restarted or far behind
+        return f"Index writer not available, try again later: {e}", 503
     except Exception as e:
         return f"Error indexing URL {url}: {e}", 500
 
 
-@app.route("/search", methods =["GET"])
-def search():
+def search_page(query, page, per_page):     #one page of results from the configured backend
+    if app.config["SEARCH_BACKEND"] == "memory":
+        from memory_index import search_memory_page      #numpy is only needed for this backend
+        return search_memory_page(query, index_dir, page=page, per_page=per_page)
+    from index_builder_whoosh import search_page_index
+    return search_page_index(query, index_dir, page=page, per_page=per_page)
+
+
+def search_args():
+    """
+    query, page and per_page of a search request, page and per_page are clamped to sane values.
+    """
     query = request.args.get("q", "").strip()   # request.args.get("q"): Extracts the q parameter from the URL.
                                                 #strip(): Removes leading or trailing spaces from the query.
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = min(MAX_PER_PAGE, max(1, request.args.get("per_page", 10, type=int)))
+    return query, page, per_page
+
+
+@app.route("/search", methods =["GET"])
+def search():
+    query, page, per_page = search_args()
     if not query:       #handle empty query
-        return render_template("error.html", message="No search query provided!"), 400
+        return render("error.html", message="No search query provided!"), 400
 
-    results = search_index(query, index_dir)
-    if results:
-        return render_template("results.html", query=query, results=results, Markup=Markup)
+    found = search_page(query, page, per_page)
+    if found["results"]:
+        return render("results.html", query=query, results=found["results"], pagination=found, Markup=Markup)
     else:
-        return render_template("no_results.html", query=query)
+        return render("no_results.html", query=query)
+
+
+@app.route("/api/search", methods=["GET"])
+def api_search():       #same as /search but as json: query, page, per_page, total, pagecount and results
+    query, page, per_page = search_args()
+    if not query:
+        return jsonify({"error": "No search query provided!"}), 400
+    return jsonify(search_page(query, page, per_page))
+
+
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():      #hit/miss counters of the search result caches of all workers to size them
+    from index_builder_whoosh import result_cache_stats
+    return jsonify(result_cache_stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():          #latency histograms and cache counters in the Prometheus text format, of all processes under gunicorn
+    import index_builder_whoosh        #registers the result cache counters, also before the first search
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
 
     
-if __name__ == "__main__":
+if __name__ == "__main__":     #dev server, for several worker processes run gunicorn -c gunicorn.conf.py
+    get_index_writer()      #creates the index if there is none yet
+    open_index()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+pages/sec of the old recursive crawl against crawl_concurrent and crawl_staged.
+a local http server stands in for the real site so the numbers don't depend on the network,
+every response is delayed by --latency seconds to act like a round trip.
+the last run re-crawls with a state file, where the unchanged pages are answered with 304.
+
+    python benchmarks/bench_crawl.py --pages 200 --latency 0.05 --workers 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from crwl import WebCrawler
+
+
+def make_handler(pages, fanout, latency):
+    """
+    request handler for a synthetic site of `pages` pages where page i links to the next `fanout` pages.
+    pages never change, so every conditional request with the page's ETag gets a 304.
+    """
+    class SiteHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"       #keep-alive, so the pooled session can reuse connections
+
+        def do_GET(self):
+            time.sleep(latency)
+            if self.path == "/robots.txt":
+                self.send_page("User-agent: *\nAllow: /\n", "text/plain")
+                return
+            try:
+                number = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+            except ValueError:
+                number = -1
+            if not 0 <= number < pages:
+                self.send_error(404)
+                return
+            etag = f'"page-{number}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            links = "".join(
+                f'<a href="/page/{(number * fanout + k) % pages}.html">page {k}</a>' for k in range(1, fanout + 1)
+            )
+            html = (
+                f"<html><head><title>Page {number}</title></head><body>"
+                f"<div><p>Synthetic benchmark page number {number} with some words to index.</p></div>"
+                f"{links}</body></html>"
+            )
+            self.send_page(html, "text/html; charset=utf-8", etag)
+
+        def send_page(self, body, content_type, etag=None):
+            data = body.encode("utf-8")
+            self.send_response(200)
+            if etag:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):     #keep the benchmark output readable
+            pass
+
+    return SiteHandler
+
+
+def run(label, crawler, crawl):
+    start = time.perf_counter()
+    crawl(crawler.baseURL)
+    crawler.close()                 #the last index commit is part of the crawl
+    elapsed = time.perf_counter() - start
+    pages = crawler.page_count
+    print(f"{label:<12} {pages:>5} pages in {elapsed:7.2f}s  {pages / elapsed:8.1f} pages/sec")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--pages", type=int, default=200)
+    arg_parser.add_argument("--fanout", type=int, default=4)
+    arg_parser.add_argument("--latency", type=float, default=0.05, help="seconds the server waits before answering")
+    arg_parser.add_argument("--workers", type=int, default=8)
+    arg_parser.add_argument("--per-host", type=int, default=8)
+    args = arg_parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.pages, args.fanout, args.latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/page/0.html"
+
+    def crawler(index_dir, state_path=None):
+        return WebCrawler(base_url, max_depth=args.pages, index_dir=index_dir, max_pages=args.pages,
+                          workers=args.workers, per_host=args.per_host, state_path=state_path)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        serial = crawler(os.path.join(tmp, "serial"))
+        run("serial", serial, serial.crawl)
+
+        concurrent = crawler(os.path.join(tmp, "concurrent"))
+        run("concurrent", concurrent, concurrent.crawl_concurrent)
+
+        staged = crawler(os.path.join(tmp, "staged"))
+        run("staged", staged, staged.crawl_staged)
+
+        state_path = os.path.join(tmp, "crawl_state.db")
+        for label in ("first crawl", "re-crawl"):
+            incremental = crawler(os.path.join(tmp, "incremental"), state_path)
+            run(label, incremental, incremental.crawl_concurrent)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
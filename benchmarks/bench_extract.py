@@ -0,0 +1,84 @@
+"""
+MB/s and pages/s of extract_page against the old extraction, which parsed every page twice with
+BeautifulSoup (once for the index fields, once more in parse_links for the links).
+
+    python benchmarks/bench_extract.py --corpus saved_pages/     #every *.html file below the dir
+    python benchmarks/bench_extract.py --synthetic 500            #generated pages with nested divs
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from extract import BACKEND, extract_page
+from bench_index import WORDS
+
+
+def legacy_extract(html, url):
+    """
+    the extraction of add_to_index and WebCrawler.parse_links before extract_page.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    title = soup.title.string.strip() if soup.title and soup.title.string else "No Title"
+    meta_desc = soup.find("meta", {"name": "description"})
+    teaser = (
+        meta_desc["content"].strip()
+        if meta_desc and meta_desc.get("content")
+        else ' '.join(soup.stripped_strings)[:200] + "..."
+    )
+    content = ' '.join([tag.get_text() for tag in soup.find_all(['p', 'div']) if tag.get_text()])
+    links = [urljoin(url, tag["href"]) for tag in BeautifulSoup(html, "html.parser").find_all("a", href=True)]
+    return title, teaser, content, links
+
+
+def saved_pages(corpus):
+    for root, _, names in os.walk(corpus):
+        for name in sorted(names):
+            if name.endswith((".html", ".htm")):
+                with open(os.path.join(root, name), encoding="utf-8", errors="replace") as file:
+                    yield "http://corpus.local/" + name, file.read()
+
+
+def synthetic_pages(count, seed=0):
+    rng = random.Random(seed)
+    for number in range(count):
+        paragraphs = "".join(
+            "<div><div><p>" + " ".join(rng.choice(WORDS) for _ in range(80)) + "</p></div></div>" for _ in range(8)
+        )
+        links = "".join(f'<a href="/page/{rng.randrange(count)}.html">link</a>' for _ in range(20))
+        yield f"http://bench.local/page/{number}.html", (
+            f"<html><head><title>Page {number}</title><style>p {{color: red}}</style></head>"
+            f"<body><div class='wrapper'><div class='main'>{paragraphs}</div><nav>{links}</nav></div></body></html>"
+        )
+
+
+def run(label, pages, extract):
+    size = sum(len(html.encode("utf-8")) for _, html in pages)
+    start = time.perf_counter()
+    for url, html in pages:
+        extract(html, url)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {len(pages) / elapsed:9.1f} pages/s  {size / elapsed / 1e6:7.2f} MB/s")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--corpus", help="directory of saved .html pages")
+    arg_parser.add_argument("--synthetic", type=int, default=500, help="pages to generate when there is no corpus")
+    args = arg_parser.parse_args()
+
+    pages = list(saved_pages(args.corpus) if args.corpus else synthetic_pages(args.synthetic))
+    if not pages:
+        sys.exit("no pages found")
+    print(f"{len(pages)} pages, {sum(len(html) for _, html in pages) / 1e6:.1f} MB")
+    run("beautifulsoup x2", pages, legacy_extract)
+    run(f"extract_page ({BACKEND})", pages, extract_page)
+
+
+if __name__ == "__main__":
+    main()
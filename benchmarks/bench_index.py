@@ -0,0 +1,78 @@
+"""
+docs/sec of add_to_index (open_dir + AsyncWriter + commit per page) against IndexBatchWriter.
+both paths index the same synthetic pages into a fresh temporary index.
+
+    python benchmarks/bench_index.py --docs 10000 --batch-size 500
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index_builder_whoosh import IndexBatchWriter, add_to_index, initialize_index
+
+WORDS = ("search engine crawler index whoosh python flask query page link text content title "
+         "teaser osnabrueck university web document result ranking token segment commit").split()
+
+
+def synthetic_pages(count, seed=0):
+    """
+    (url, html) pairs with a few random paragraphs each.
+    """
+    rng = random.Random(seed)
+    for number in range(count):
+        paragraphs = "".join(
+            "<p>" + " ".join(rng.choice(WORDS) for _ in range(60)) + "</p>" for _ in range(5)
+        )
+        html = (
+            f"<html><head><title>Synthetic page {number}</title>"
+            f'<meta name="description" content="Synthetic page {number} for the index benchmark"></head>'
+            f"<body><div>{paragraphs}</div></body></html>"
+        )
+        yield f"http://bench.local/page/{number}.html", html
+
+
+def run(label, docs, index):
+    with tempfile.TemporaryDirectory() as index_dir:
+        with contextlib.redirect_stdout(io.StringIO()):     #both paths print per commit
+            start = time.perf_counter()
+            index(index_dir, synthetic_pages(docs))
+            elapsed = time.perf_counter() - start
+        segments = len([name for name in os.listdir(index_dir) if name.endswith(".seg")])
+    print(f"{label:<12} {docs:>6} docs in {elapsed:8.2f}s  {docs / elapsed:8.1f} docs/sec  {segments} segment files")
+
+
+def per_document(index_dir, pages):
+    initialize_index(index_dir)
+    for url, html in pages:
+        add_to_index(index_dir, url, html)
+
+
+def batched(batch_size):
+    def index(index_dir, pages):
+        with IndexBatchWriter(index_dir, batch_size=batch_size, commit_interval=None) as writer:
+            for url, html in pages:
+                writer.add(url, html)
+            writer.optimize()
+    return index
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--docs", type=int, default=10000)
+    arg_parser.add_argument("--per-doc-docs", type=int, default=None,
+                            help="docs for the per document path if it should run on fewer (it is slow)")
+    arg_parser.add_argument("--batch-size", type=int, default=500)
+    args = arg_parser.parse_args()
+
+    run("per-doc", args.per_doc_docs or args.docs, per_document)
+    run("batched", args.docs, batched(args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
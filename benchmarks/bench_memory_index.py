@@ -0,0 +1,97 @@
+"""
+queries/sec and latency of the in-memory index against the Whoosh backend on the same corpus,
+plus how long building, saving and loading the memory index snapshot take.
+the result cache of the Whoosh backend is switched off so both backends run every query.
+
+    python benchmarks/bench_memory_index.py --docs 10000 --queries 2000
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index_builder_whoosh import IndexBatchWriter, result_cache, search_page_index
+from memory_index import MemoryIndex
+from bench_index import WORDS
+
+RARE_WORDS = [f"topic{number}" for number in range(5000)]      #long tail so posting lists differ in length
+
+
+def pages(count, seed=0):
+    """
+    (url, html) pairs with the common WORDS and a zipf distributed tail of rarer words.
+    """
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(RARE_WORDS))]
+    for number in range(count):
+        words = [rng.choice(WORDS) for _ in range(200)] + rng.choices(RARE_WORDS, weights, k=100)
+        rng.shuffle(words)
+        paragraphs = "".join("<p>" + " ".join(words[start:start + 60]) + "</p>" for start in range(0, len(words), 60))
+        html = (
+            f"<html><head><title>Synthetic page {number}</title>"
+            f'<meta name="description" content="Synthetic page {number} for the memory index benchmark"></head>'
+            f"<body><div>{paragraphs}</div></body></html>"
+        )
+        yield f"http://bench.local/page/{number}.html", html
+
+
+def run(label, queries, search):
+    latencies = []
+    start = time.perf_counter()
+    for query in queries:
+        query_start = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - query_start)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p50, p99 = (latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000 for fraction in (0.5, 0.99))
+    print(f"{label:<8} {len(queries) / elapsed:8.1f} queries/sec  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--docs", type=int, default=10000)
+    arg_parser.add_argument("--queries", type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(1)
+    queries = [
+        " ".join(rng.sample(WORDS, rng.randint(1, 2)) + rng.sample(RARE_WORDS[:200], rng.randint(0, 1)))
+        for _ in range(args.queries)
+    ]
+    result_cache.maxsize = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index_dir = os.path.join(tmp, "index")
+        with contextlib.redirect_stdout(io.StringIO()), IndexBatchWriter(index_dir, commit_interval=None) as writer:
+            for url, html in pages(args.docs):
+                writer.add(url, html)
+            writer.optimize()
+
+        start = time.perf_counter()
+        memory_index = MemoryIndex.from_whoosh(index_dir)
+        print(f"build    {time.perf_counter() - start:8.2f}s  {len(memory_index.urls)} docs, {len(memory_index.vocabulary)} terms, "
+              f"{memory_index.postings.nbytes / 1024:.0f} KiB compressed postings")
+        path = os.path.join(tmp, "index.memory")
+        start = time.perf_counter()
+        memory_index.save(path)
+        print(f"save     {time.perf_counter() - start:8.3f}s  {os.path.getsize(path) / 1024:.0f} KiB snapshot")
+        start = time.perf_counter()
+        memory_index = MemoryIndex.load(path)
+        print(f"load     {time.perf_counter() - start:8.3f}s")
+
+        totals = [(search_page_index(query, index_dir)["total"], memory_index.search(query)["total"]) for query in queries[:50]]
+        mismatches = sum(1 for whoosh_total, memory_total in totals if whoosh_total != memory_total)
+        print(f"hit counts differ on {mismatches} of {len(totals)} queries")
+
+        run("whoosh", queries, lambda query: search_page_index(query, index_dir))
+        run("memory", queries, memory_index.search)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+startup time and search throughput of the app under gunicorn with 1 to N workers.
+for every worker count a fresh gunicorn (gunicorn.conf.py, so with the shared writer process) serves
+a synthetic index, startup is the time until the first search is answered. Then pages are posted
+to /index through all workers and the search load runs.
+the import time of the app module is reported first, it is what every worker pays before serving.
+the repo has to be checked out as AIandWEB2, like for the app itself.
+
+    python benchmarks/bench_serving.py --docs 5000 --max-workers 4 --requests 2000
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+from index_builder_whoosh import IndexBatchWriter
+from bench_index import WORDS, synthetic_pages
+from load_search import http_query, percentile
+
+
+def import_time(env):
+    code = "import time; start = time.perf_counter(); import AIandWEB2.app; print(time.perf_counter() - start)"
+    return float(subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout)
+
+
+def wait_for(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urlopen(base_url + "/search?" + urlencode({"q": WORDS[0]}), timeout=5) as response:
+                response.read()
+            return
+        except (URLError, ConnectionError):
+            time.sleep(0.02)
+    raise RuntimeError(f"no answer from {base_url} after {timeout}s")
+
+
+def post_pages(base_url, pages, threads):
+    def post(page):
+        url, html = page
+        with urlopen(base_url + "/index", data=urlencode({"url": url, "html": html}).encode(), timeout=30) as response:
+            response.read()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(post, pages))
+    return time.perf_counter() - start
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--docs", type=int, default=5000, help="pages in the index before the server starts")
+    arg_parser.add_argument("--posts", type=int, default=200, help="pages posted to /index per run")
+    arg_parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    arg_parser.add_argument("--requests", type=int, default=2000)
+    arg_parser.add_argument("--threads", type=int, default=16)
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--backend", choices=("whoosh", "memory"), default="whoosh")
+    args = arg_parser.parse_args()
+
+    rng = random.Random(1)
+    queries = [" ".join(rng.sample(WORDS, rng.randint(1, 2))) for _ in range(50)]
+    mix = [rng.choice(queries) for _ in range(args.requests)]
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index_dir = os.path.join(tmp, "index")
+        with contextlib.redirect_stdout(io.StringIO()), IndexBatchWriter(index_dir, commit_interval=None) as writer:
+            for url, html in synthetic_pages(args.docs):
+                writer.add(url, html)
+            writer.optimize()
+
+        env = dict(os.environ, SEARCH_INDEX_DIR=index_dir, SEARCH_BACKEND=args.backend, SEARCH_BIND=f"127.0.0.1:{args.port}",
+                   PYTHONPATH=os.pathsep.join([os.path.dirname(repo_dir), os.environ.get("PYTHONPATH", "")]))
+        print(f"import AIandWEB2.app: {import_time(env) * 1000:.0f} ms")
+
+        posted = list(synthetic_pages(args.docs + args.posts))[args.docs:]
+        for workers in range(1, args.max_workers + 1):
+            start = time.perf_counter()
+            server = subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", "-c", os.path.join(repo_dir, "gunicorn.conf.py"), "--workers", str(workers)],
+                env=dict(env, SEARCH_WORKERS=str(workers)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            try:
+                wait_for(base_url)
+                startup = time.perf_counter() - start
+                posting = post_pages(base_url, posted, args.threads)
+
+                query = http_query(base_url)
+
+                def timed(text):
+                    query_start = time.perf_counter()
+                    query(text)
+                    return time.perf_counter() - query_start
+
+                load_start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                    latencies = sorted(pool.map(timed, mix))
+                elapsed = time.perf_counter() - load_start
+            finally:
+                server.terminate()
+                server.wait(60)
+            print(f"{workers} workers: startup {startup:6.2f}s  {len(posted) / posting:7.1f} posts/s  "
+                  f"{len(mix) / elapsed:7.1f} req/s  p50 {percentile(latencies, 0.5) * 1000:7.2f} ms  "
+                  f"p99 {percentile(latencies, 0.99) * 1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
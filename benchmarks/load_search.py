@@ -0,0 +1,85 @@
+"""
+concurrent load test for search, prints throughput and latency percentiles.
+
+against a running server:
+    python benchmarks/load_search.py --url http://127.0.0.1:5000 --threads 8 --requests 2000
+in process against an index dir, --cold closes the shared searchers before every query
+which is what every request paid before the searcher pool (open_dir + TOC + new parser):
+    python benchmarks/load_search.py --index-dir /tmp/bench_index --populate 5000
+    python benchmarks/load_search.py --index-dir /tmp/bench_index --cold
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index_builder_whoosh import IndexBatchWriter, close_shared_index, search_index
+from bench_index import WORDS, synthetic_pages
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def http_query(base_url):
+    def query(text):
+        with urlopen(base_url.rstrip("/") + "/search?" + urlencode({"q": text}), timeout=30) as response:
+            response.read()
+    return query
+
+
+def index_query(index_dir, cold):
+    def query(text):
+        if cold:
+            close_shared_index(index_dir)
+        search_index(text, index_dir)
+    return query
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = arg_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="base url of a running app")
+    target.add_argument("--index-dir", help="query this index in process")
+    arg_parser.add_argument("--populate", type=int, default=0, help="first index this many synthetic pages into --index-dir")
+    arg_parser.add_argument("--cold", action="store_true", help="reopen the index for every query (in process only)")
+    arg_parser.add_argument("--threads", type=int, default=8)
+    arg_parser.add_argument("--requests", type=int, default=2000)
+    arg_parser.add_argument("--distinct", type=int, default=50, help="number of distinct queries in the mix")
+    args = arg_parser.parse_args()
+
+    if args.populate:
+        with contextlib.redirect_stdout(io.StringIO()), IndexBatchWriter(args.index_dir, commit_interval=None) as writer:
+            for url, html in synthetic_pages(args.populate):
+                writer.add(url, html)
+
+    rng = random.Random(1)
+    queries = [" ".join(rng.sample(WORDS, rng.randint(1, 2))) for _ in range(args.distinct)]
+    mix = [rng.choice(queries) for _ in range(args.requests)]
+    query = http_query(args.url) if args.url else index_query(args.index_dir, args.cold)
+
+    def timed(text):
+        start = time.perf_counter()
+        query(text)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        latencies = sorted(pool.map(timed, mix))
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(mix)} requests, {args.threads} threads, {elapsed:.2f}s, {len(mix) / elapsed:.1f} req/s")
+    for label, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+        print(f"{label}: {percentile(latencies, fraction) * 1000:8.2f} ms")
+    print(f"max: {latencies[-1] * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Crawl frontier and per url fetch state kept in a sqlite file, so an interrupted crawl can be resumed
+and a re-crawl only downloads the pages that changed (conditional requests with ETag/Last-Modified).
+"""
+import json
+import sqlite3
+import threading
+import time
+
+NOT_MODIFIED = object()     #returned by WebCrawler.fetch_page when the server answered 304
+
+QUEUED = "queued"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS frontier (
+    url TEXT PRIMARY KEY,
+    depth INTEGER NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    links TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+
+class CrawlState:
+    """
+    sqlite backed crawl state.
+    frontier holds the urls of the current run, pages the validators and outbound links of every page ever fetched.
+    Changes are only made durable by commit(), the crawler calls it right after each index commit
+    and rollback() after a failed one, so the state never claims a page is done before its document is in the index.
+    path: the sqlite file
+    """
+    def __init__(self, path="crawl_state.db"):
+        self.path = path
+        self.lock = threading.Lock()        #fetch threads read validators while the crawl thread writes
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+            self.db.commit()
+
+    def begin(self, URL):
+        """
+        start a new crawl run from URL, or resume the last run if it never finished.
+        returns (pending, done, seen): the (url, depth) pairs still to fetch in frontier order,
+        the urls already done in this run and every url that was queued in this run.
+        """
+        with self.lock:
+            run = self.db.execute("SELECT id FROM runs WHERE finished IS NULL ORDER BY id DESC LIMIT 1").fetchone()
+            if run is None:
+                self.db.execute("DELETE FROM frontier")
+                self.db.execute("INSERT INTO runs (started) VALUES (?)", (time.time(),))
+                self.db.execute("INSERT INTO frontier (url, depth, state) VALUES (?, 0, ?)", (URL, QUEUED))
+                self.db.commit()
+            rows = self.db.execute("SELECT url, depth, state FROM frontier ORDER BY rowid").fetchall()
+
+        pending = [(url, depth) for url, depth, state in rows if state == QUEUED]
+        done = {url for url, _, state in rows if state == DONE}
+        if run is not None:
+            print(f"resuming crawl from {self.path}: {len(done)} pages done, {len(pending)} queued")
+        return pending, done, {url for url, _, _ in rows}
+
+    def enqueue(self, urls, depth):
+        """
+        add urls found at depth to the frontier of this run.
+        """
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO frontier (url, depth, state) VALUES (?, ?, ?)",
+                [(url, depth, QUEUED) for url in urls],
+            )
+
+    def page_fetched(self, url, links, etag=None, last_modified=None):
+        """
+        mark url done in this run and remember its validators and outbound links for the next run.
+        """
+        with self.lock:
+            self.db.execute("UPDATE frontier SET state = ? WHERE url = ?", (DONE, url))
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, links, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (url, etag, last_modified, json.dumps(links), time.time()),
+            )
+
+    def page_unchanged(self, url):
+        """
+        mark url done in this run after a 304, its stored validators and links stay valid.
+        """
+        with self.lock:
+            self.db.execute("UPDATE frontier SET state = ? WHERE url = ?", (DONE, url))
+            self.db.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url))
+
+    def page_failed(self, url):
+        with self.lock:
+            self.db.execute("UPDATE frontier SET state = ? WHERE url = ?", (FAILED, url))
+
+    def validators(self, url):
+        """
+        (etag, last_modified) of the last fetch of url, both None if it was never fetched.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified FROM pages WHERE url = ?", (url,)).fetchone()
+        return row if row is not None else (None, None)
+
+    def stored_links(self, url):
+        """
+        outbound links of url from its last fetch.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT links FROM pages WHERE url = ?", (url,)).fetchone()
+        return json.loads(row[0]) if row is not None else []
+
+    def finish_run(self):
+        """
+        mark the current run complete, the next begin() starts a new one.
+        """
+        with self.lock:
+            self.db.execute("UPDATE runs SET finished = ? WHERE finished IS NULL", (time.time(),))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def rollback(self):
+        """
+        drop the changes since the last commit, the crawler calls it when an index commit failed.
+        """
+        with self.lock:
+            self.db.rollback()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
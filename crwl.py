@@ -1,39 +1,95 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin, urlparse #to join the base url with the relative url and extract the domain of each link
-from index_builder_whoosh import initialize_index, add_to_index
+from index_builder_whoosh import IndexBatchWriter
+from extract import extract_page
+from pipeline import CrawlPipeline
+from crawl_state import CrawlState, NOT_MODIFIED
+import metrics
 from urllib.robotparser import RobotFileParser
-import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import argparse
+import atexit
+import threading
+import time
 
 
 class WebCrawler:
-    def __init__(self, baseURL="https://vm009.rz.uos.de/crawl/index.html", max_depth = 5, index_dir="index", max_pages = 100):
+    def __init__(self, baseURL="https://vm009.rz.uos.de/crawl/index.html", max_depth = 5, index_dir="index", max_pages = 100,
+                 workers = 8, per_host = 2, delay = 0.0, state_path = None, near_duplicates = False):
         """
         initializing the crawler
         baseURL: starting URL
         max_depth: depths of the links to follow
         index_dir: dir for the whoosh indx
         max_pages: Maximum number of pages to crawl
+        workers: number of pages fetched at the same time by crawl_concurrent
+        per_host: maximum number of open requests to a single host
+        delay: minimum seconds between two requests to the same host (raised to the robots.txt Crawl-delay if that is bigger)
+        state_path: sqlite file for the frontier and ETag/Last-Modified of every page, makes crawls resumable and re-crawls incremental
+        near_duplicates: also skip indexing pages that are nearly the same as an indexed one (SimHash), not only exact copies
         """
         self.baseURL = baseURL
         self.max_depth = max_depth
         self.index_dir = index_dir
         self.max_pages = max_pages
+        self.workers = workers
+        self.per_host = per_host
         self.visitedURLs = set() #initialize an empty set as a it remember the URLs that already visited
         self.page_count = 0
+        self.unchanged_count = 0    #pages skipped because the server answered 304
         self.base_domain = urlparse(baseURL).netloc #extract and store the domain of the base url
-        
-        
 
-        if not os.path.exists(index_dir): #initialize whoosh indx
-            os.mkdir(index_dir)
-        initialize_index(index_dir)
+        #one pooled session for all requests so connections are kept alive and reused between pages
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(workers, per_host))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._host_slots = {}           #host -> semaphore limiting the open requests to that host
+        self._host_next = {}            #host -> earliest time the next request to that host may start
+        self._host_lock = threading.Lock()
+
+        self.writer = IndexBatchWriter(index_dir, near_duplicates=near_duplicates)   #one writer for the whole crawl, commits in batches
+        self._closed = False
+        atexit.register(self.close)     #callers that never close() the crawler would lose the last batch, mostly the whole crawl
+
+        self.state = None
+        self._validators = {}           #url -> (etag, last_modified) of fetched pages until they are stored
+        self._lost = set()              #urls whose documents were dropped by a failed index commit
+        self._lost_lock = threading.Lock()
+        if state_path:
+            self.state = CrawlState(state_path)
+            self.writer.commit_hooks.append(self.state.commit)     #crawl state is only saved together with the index
+        self.writer.failure_hooks.append(self.pages_lost)
 
         #setup robots.txt parser
         self.robot_parser = RobotFileParser()   #handle th rules defined in robots.txt file of the website being crawled to tell crawlers which parts of the site are allowed or disallowed for crawling
         self.robot_parser.set_url(urljoin(baseURL, "/robots.txt"))
         self.robot_parser.read()
+        self.delay = max(delay, self.robot_parser.crawl_delay("*") or 0)
     
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """
+        commit the last batch of indexed pages and close the http session and crawl state.
+        also called at exit, closing more than once does nothing.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self.writer.close()
+        self.session.close()
+        if self.state is not None:
+            self.state.close()
+
     def is_allowed(self, url):
         """
         Check if a URL is allowed to be crawled based on robots.txt rules.
@@ -44,12 +100,24 @@ class WebCrawler:
         """
         to fetch the HTML content of the URL.
         url: the URL to fetch
-        returns the content as a string or None if it fails.
+        returns the content as a string or None if it fails, NOT_MODIFIED if it did not change since the last crawl.
         """
+        headers = {}
+        if self.state is not None:          #conditional request so unchanged pages are answered with an empty 304
+            etag, last_modified = self.state.validators(url)
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
         try: 
-            response = requests.get(url, timeout=5)    #retrieve the url in 5 sec
+            with metrics.timed("fetch"):
+                response = self.session.get(url, timeout=5, headers=headers)    #retrieve the url in 5 sec
+            if response.status_code == 304 and headers:
+                return NOT_MODIFIED
             if response.status_code == 200 and "text/html" in response.headers.get("Content-type", ""):            #checking the request status is successful and is an HTML
                 response.encoding = response.apparent_encoding
+                if self.state is not None:
+                    self._validators[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
                 return response.text                   #returning the content as s string
             else:                                      #if the request is not successful return nothing
                 print(f"Skipped non-HTML or unsuccessful response: {url} (Statues: {response.status_code})")
@@ -58,6 +126,27 @@ class WebCrawler:
                                             #all other possible errors return nothing 
             print(f"Error fetching {url}: {e}")
             return None
+
+    def polite_fetch(self, url):
+        """
+        fetch_page with the per host limits applied, safe to call from several threads.
+        waits for a free slot of the host and for the crawl delay since the last request to it.
+        """
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+                self._host_next[host] = 0.0
+            slot = self._host_slots[host]
+
+        with slot:
+            with self._host_lock:       #reserve the next start time so parallel requests are spaced by the delay
+                now = time.monotonic()
+                start = max(now, self._host_next[host])
+                self._host_next[host] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            return self.fetch_page(url)
         
     def parse_links(self, html, currentURL):
         """
@@ -65,35 +154,136 @@ class WebCrawler:
         html: the html content of the page
         return a list of absolute urls
         """
-        soup = BeautifulSoup(html,"html.parser")
-        links = []                                      #initializing the list of URLs
-
-        for tag in soup.find_all("a", href = True):     #finding all the hyperlinks
-            relativeURL = tag['href']
-            absoluteURL = urljoin(currentURL, relativeURL) #resolve the urls to an absolute format
-            parsedURL = urlparse(absoluteURL)
-            if parsedURL.netloc == self.base_domain:          #filtering only the links within the same domain
-                normalized_url = self.normalize_url(absoluteURL)
-                links.append(normalized_url)
+        return self.same_domain_links(extract_page(html, currentURL).links)
 
-        return links
+    def same_domain_links(self, links):
+        """
+        filtering the absolute urls of a page to the ones within the same domain
+        links: absolute urls, e.g. Page.links of extract_page
+        return a list of normalized urls
+        """
+        return [self.normalize_url(link) for link in links if urlparse(link).netloc.lower() == self.base_domain.lower()]
     
+    def start_frontier(self, URL):
+        """
+        frontier and queued urls for a frontier crawl from URL.
+        with a state file an interrupted crawl continues where it stopped instead of starting over.
+        returns a deque of (url, depth) pairs and the set of normalized urls that were queued already
+        """
+        if self.state is None:
+            pending, done, seen = [(URL, 0)], set(), {URL}
+        else:
+            pending, done, seen = self.state.begin(URL)
+        self.visitedURLs |= {self.normalize_url(url) for url in done}
+        self.page_count += len(done)
+        queued = self.visitedURLs | {self.normalize_url(url) for url in seen}
+        return deque(pending), queued
+
+    def follow_links(self, links, depth, frontier, queued):
+        """
+        queue the same domain links of a page at depth that were not queued before, if max_depth allows it.
+        """
+        if depth >= self.max_depth:
+            return
+        new_links = []
+        for link in self.same_domain_links(links):
+            if link not in queued:
+                queued.add(link)
+                frontier.append((link, depth + 1))
+                new_links.append(link)
+        if self.state is not None and new_links:
+            self.state.enqueue(new_links, depth + 1)
+
+    def unchanged_links(self, url):
+        """
+        outbound links of a page that answered 304, from the last time it was fetched.
+        """
+        return self.state.stored_links(url)
+
+    def page_done(self, url, links, changed=True):
+        """
+        count a crawled page and store its links and validators in the crawl state.
+        changed: False for pages that answered 304 and were not indexed again
+        """
+        with self._lost_lock:           #the commit timer of the index writer may report lost pages meanwhile
+            if changed and url in self._lost:       #the commit started by its add() failed before the page was counted
+                self._lost.discard(url)
+                self.page_failed(url)
+                return
+            self.visitedURLs.add(self.normalize_url(url))
+            self.page_count += 1
+            if not changed:
+                self.unchanged_count += 1
+            if self.state is None:
+                return
+            if changed:
+                etag, last_modified = self._validators.pop(url, (None, None))
+                self.state.page_fetched(url, links, etag, last_modified)
+            else:
+                self.state.page_unchanged(url)
+
+    def page_failed(self, url):
+        """
+        remember that url could not be crawled so a resumed crawl does not retry it.
+        """
+        if self.state is not None:
+            self.state.page_failed(url)
+
+    def pages_lost(self, urls):
+        """
+        failure hook of the index writer: the documents of urls were dropped by a failed commit.
+        the crawl state goes back to the last index commit and the pages count as failed,
+        so a resumed crawl or re-crawl does not take them as indexed because of their stored ETag.
+        """
+        print(f"index commit failed, {len(urls)} pages were not indexed")
+        with self._lost_lock:
+            if self.state is not None:
+                self.state.rollback()
+            for url in urls:
+                if self.normalize_url(url) in self.visitedURLs:     #already counted as done
+                    self.visitedURLs.discard(self.normalize_url(url))
+                    self.page_count -= 1
+                    self.page_failed(url)
+                else:                   #added but not counted yet, page_done reports it
+                    self._lost.add(url)
+
+    def finish_crawl(self):
+        """
+        mark the crawl complete in the state file, the next crawl starts a fresh run.
+        """
+        if self.unchanged_count:
+            print(f"{self.unchanged_count} of {self.page_count} pages were unchanged and not downloaded or indexed again")
+        if self.writer.saved_writes():
+            stats = self.writer.stats
+            print(f"index writes saved: {stats['unchanged']} pages with unchanged content, {stats['duplicate']} exact "
+                  f"and {stats['near_duplicate']} near duplicates of other urls, {stats['written']} pages written")
+        if self.state is not None:
+            self.state.finish_run()
+
     @staticmethod
     def normalize_url(url):
         """
         Normalize a URL to ensures that URLs are stored
         in a consistent format by removing fragments and query strings.
+        scheme and host are lowercased, default ports dropped and an empty path becomes "/".
         """
         parsed = urlparse(url)
-        return parsed.scheme + "://" + parsed.netloc + parsed.path
+        scheme = parsed.scheme.lower()
+        netloc = parsed.netloc.lower()
+        if (scheme, netloc.rpartition(":")[2]) in (("http", "80"), ("https", "443")):
+            netloc = netloc.rpartition(":")[0]
+        return scheme + "://" + netloc + (parsed.path or "/")
 
 
     def crawl(self, URL, depth = 0):
         """
         exploring links and exteacting contents
+        does not keep a frontier, so it can't be resumed and must not be used with a crawl state
         url: the strarting url
         depth: how deep the crawler is
         """
+        if self.state is not None:
+            raise ValueError("the recursive crawl does not use a crawl state, use crawl_concurrent or crawl_staged")
         if depth > self.max_depth or self.page_count >= self.max_pages:  #checking the depth and page count so it doesn't crawl more than neccesary
             return
         
@@ -108,17 +298,98 @@ class WebCrawler:
 
         html = self.fetch_page(URL)                 #downloading the current url's page
 
-        if html:                                    #add the contnt to the woosh indx
-            add_to_index(self.index_dir, URL, html)
+        if html is NOT_MODIFIED:                    #unchanged since the last crawl, follow its stored links without indexing again
+            links = self.unchanged_links(URL)
+            self.page_done(URL, links, changed=False)
+        elif html:                                    #add the contnt to the woosh indx
+            page = extract_page(html, URL)              #parse once for the index and the links
+            self.writer.add(URL, page=page)
+            links = page.links
+            self.page_done(URL, links)                   #adding the currnt url to visited ones
+        else:
+            return
 
-            self.visitedURLs.add(normalized_url)                   #adding the currnt url to visited ones
-            self.page_count += 1
-            links = self.parse_links(html, URL)               #extracting all the valid links 
+        for link in self.same_domain_links(links):                          #crawling the links
+            self.crawl(link, depth + 1)
+
+    def crawl_concurrent(self, URL=None):
+        """
+        breadth first crawl from a frontier queue with up to self.workers pages fetched at the same time.
+        follows the same max_depth/max_pages rules as crawl but without recursion.
+        resumes an interrupted crawl when the crawler has a state file.
+        URL: the starting url, defaults to baseURL
+        """
+        frontier, queued = self.start_frontier(URL or self.baseURL)     #(url, depth) pairs waiting to be fetched and every url queued so far
+        in_flight = {}                          #future -> (url, depth) of the pages being fetched right now
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while frontier or in_flight:
+                #keep the workers busy but never start more pages than max_pages allows
+                while frontier and len(in_flight) < self.workers and self.page_count + len(in_flight) < self.max_pages:
+                    url, depth = frontier.popleft()
+                    if not self.is_allowed(url):
+                        print(f"skipping disallowed url: {url}")
+                        self.page_failed(url)
+                        continue
+                    print(f"crawling {url} in depth {depth}")
+                    in_flight[pool.submit(self.polite_fetch, url)] = (url, depth)
+
+                if not in_flight:               #page limit reached or nothing left that is allowed
+                    break
 
-            for link in links:                          #crawling the links
-                self.crawl(link, depth + 1)
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, depth = in_flight.pop(future)
+                    html = future.result()
+                    if html is NOT_MODIFIED:
+                        links = self.unchanged_links(url)
+                        self.page_done(url, links, changed=False)
+                    elif html:
+                        page = extract_page(html, url)
+                        self.writer.add(url, page=page)
+                        links = page.links
+                        self.page_done(url, links)
+                    else:                       #failed fetches free their slot for another page
+                        self.page_failed(url)
+                        continue
+                    self.follow_links(links, depth, frontier, queued)
+
+        self.finish_crawl()
+
+    def crawl_staged(self, URL=None, parse_workers=None):
+        """
+        crawl with fetching, parsing and indexing as separate stages, parsing runs on a process pool.
+        see pipeline.CrawlPipeline, prints the throughput and queue depth of every stage while it runs.
+        URL: the starting url, defaults to baseURL
+        parse_workers: number of parse processes, defaults to the number of cores
+        """
+        CrawlPipeline(self, parse_workers=parse_workers).run(URL)
 
 
 if __name__ == "__main__":          #instantiate the WebCrawler with the base URL.
-    crawler = WebCrawler()
-    crawler.crawl(crawler.baseURL)
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="crawl a site into the whoosh index")
+    arg_parser.add_argument("--serial", action="store_true", help="use the old recursive one page at a time crawl")
+    arg_parser.add_argument("--staged", action="store_true", help="parse pages on a process pool, separate from fetching and indexing")
+    arg_parser.add_argument("--workers", type=int, default=8, help="pages fetched at the same time")
+    arg_parser.add_argument("--per-host", type=int, default=2, help="open requests allowed per host")
+    arg_parser.add_argument("--state", help="sqlite file to resume crawls and skip unchanged pages (default crawl_state.db, "
+                                            "empty to disable, not supported by --serial)")
+    arg_parser.add_argument("--near-duplicates", action="store_true", help="skip pages nearly identical to an indexed one")
+    arg_parser.add_argument("--metrics-port", type=int, help="serve the fetch/parse/commit histograms on http://127.0.0.1:PORT/metrics")
+    args = arg_parser.parse_args()
+    if args.serial and args.state:
+        arg_parser.error("--serial can't resume a crawl or skip unchanged pages, leave out --state")
+    state_path = None if args.serial else args.state if args.state is not None else "crawl_state.db"
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    with WebCrawler(workers=args.workers, per_host=args.per_host, state_path=state_path or None,
+                    near_duplicates=args.near_duplicates) as crawler:
+        if args.serial:
+            crawler.crawl(crawler.baseURL)
+            crawler.finish_crawl()
+        elif args.staged:
+            crawler.crawl_staged(crawler.baseURL)
+        else:
+            crawler.crawl_concurrent(crawler.baseURL)
\ No newline at end of file
@@ -0,0 +1,184 @@
+"""
+Single pass html extraction shared by the crawler and the indexer.
+Every page is parsed once into its title, meta description, text and outbound links.
+Uses lxml's C parser when it is installed and falls back to the html.parser of the standard library,
+both stream tags and text into the same collector without building a tree.
+"""
+from collections import namedtuple
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+from metrics import timed
+
+try:
+    from lxml import etree          #optional, a lot faster than html.parser
+except ImportError:
+    etree = None
+
+BACKEND = "lxml" if etree is not None else "html.parser"
+
+SKIPPED_TAGS = {"script", "style", "template", "noscript"}     #their text is never shown on the page
+CONTENT_TAGS = {"p", "div"}
+
+#html.parser reports the tags as written, lxml (libxml2) also closes the ones the html rules leave open. _StdlibParser
+#closes them the way libxml2 does, so both backends give the same content (and content_hash) for sloppy markup
+VOID_TAGS = {"area", "base", "basefont", "br", "col", "embed", "frame", "hr", "img", "input", "isindex", "link", "meta",
+             "param", "source", "track", "wbr"}      #never have an end tag
+P_CLOSERS = {"address", "blockquote", "caption", "center", "col", "colgroup", "dd", "dir", "div", "dl", "dt", "fieldset",
+             "form", "frameset", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "li", "listing", "menu", "ol", "p", "pre",
+             "table", "tbody", "td", "tfoot", "th", "title", "tr", "ul", "xmp"}     #start tags that end an open <p>
+END_PRIORITY = {"div": 150, "td": 160, "th": 160, "tr": 170, "thead": 180, "tbody": 180, "tfoot": 180, "table": 190,
+                "head": 200, "body": 200, "html": 220}     #an end tag only closes the open tags of lower or equal priority, others 100
+
+#title: text of the <title> tag or None
+#description: content of <meta name="description"> or None
+#text: all visible text of the page
+#content: text inside <p> and <div> tags, every text node only once even for nested tags
+#links: absolute urls of the <a href> tags in page order without duplicates
+Page = namedtuple("Page", ["title", "description", "text", "content", "links"])
+
+
+class _PageCollector:
+    """
+    parser target that sees every tag and text node of a page once.
+    it has the start/end/data/close interface of an lxml target, _StdlibParser feeds it from html.parser.
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.title = []
+        self.description = None
+        self.text = []
+        self.content = []
+        self.links = []
+        self.seen_links = set()
+        self.chunks = []            #text of the current text node
+        self.in_title = 0
+        self.in_content = 0         #depth of open <p>/<div> tags
+        self.in_skipped = 0
+
+    def start(self, tag, attrib):
+        self._flush()
+        tag = tag.lower()
+        if tag in CONTENT_TAGS:
+            self.in_content += 1
+        elif tag in SKIPPED_TAGS:
+            self.in_skipped += 1
+        elif tag == "title":
+            self.in_title += 1
+        elif tag == "a":
+            href = (attrib.get("href") or "").strip()
+            if href:
+                link = urljoin(self.base_url, href)
+                if link not in self.seen_links:
+                    self.seen_links.add(link)
+                    self.links.append(link)
+        elif tag == "meta" and self.description is None and (attrib.get("name") or "").lower() == "description":
+            description = (attrib.get("content") or "").strip()
+            if description:
+                self.description = description
+
+    def end(self, tag):
+        self._flush()
+        tag = tag.lower()
+        if tag in CONTENT_TAGS:
+            self.in_content = max(0, self.in_content - 1)
+        elif tag in SKIPPED_TAGS:
+            self.in_skipped = max(0, self.in_skipped - 1)
+        elif tag == "title":
+            self.in_title = max(0, self.in_title - 1)
+
+    def data(self, data):
+        if self.in_skipped:
+            return
+        if self.in_title:
+            self.title.append(data)
+        self.chunks.append(data)    #lxml splits a text node at entities, html.parser does not
+
+    def _flush(self):
+        """
+        add the text node collected since the last tag, called before a tag changes where text goes.
+        """
+        if not self.chunks:
+            return
+        stripped = "".join(self.chunks).strip()
+        self.chunks = []
+        if stripped:
+            self.text.append(stripped)
+            if self.in_content:
+                self.content.append(stripped)
+
+    def close(self):
+        self._flush()
+        title = "".join(self.title).strip()
+        return Page(
+            title=title or None,
+            description=self.description,
+            text=" ".join(self.text),
+            content=" ".join(self.content),
+            links=self.links,
+        )
+
+
+class _StdlibParser(HTMLParser):
+    """
+    html.parser front end for _PageCollector.
+    Ends the tags that libxml2 ends implicitly, so the collector gets the same events as from lxml:
+    a <p> at the start of a block tag, and open tags inside an element at its end tag.
+    """
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+        self.open_tags = []         #tags started and not ended yet, innermost last
+
+    def handle_starttag(self, tag, attrs):
+        while tag in P_CLOSERS and self.open_tags and self.open_tags[-1] == "p":
+            self.target.end(self.open_tags.pop())
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+        self.target.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in VOID_TAGS:
+            self.target.end(tag)
+        else:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag == "br":         #</br> is a line break like <br>
+            self.handle_startendtag(tag, [])
+            return
+        if self.open_tags and self.open_tags[-1] == tag:     #well nested markup
+            self.target.end(self.open_tags.pop())
+            return
+        if tag not in self.open_tags:       #an end tag without a start tag is dropped
+            return
+        priority = END_PRIORITY.get(tag, 100)
+        position = len(self.open_tags) - 1 - self.open_tags[::-1].index(tag)
+        if any(END_PRIORITY.get(inner, 100) > priority for inner in self.open_tags[position + 1:]):
+            return          #e.g. </span> with a <div> opened inside the span
+        while len(self.open_tags) > position:
+            self.target.end(self.open_tags.pop())
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def extract_page(html, base_url=""):
+    """
+    Parse html once and return its Page.
+    html: the html content of the page
+    base_url: url of the page, relative links are resolved against it
+    """
+    collector = _PageCollector(base_url)
+    if not html or not html.strip():
+        return collector.close()
+    with timed("parse"):
+        if etree is not None:
+            parser = etree.HTMLParser(target=collector)
+            parser.feed(html)
+            return parser.close()
+        parser = _StdlibParser(collector)
+        parser.feed(html)
+        parser.close()
+        return collector.close()
@@ -0,0 +1,76 @@
+"""
+Content fingerprints used to skip re-indexing pages whose text did not change or that are
+copies of an already indexed page under another url.
+content_hash is an exact fingerprint, simhash a 64 bit sketch where similar texts differ in few bits.
+"""
+import hashlib
+import re
+from collections import Counter
+
+SIMHASH_BITS = 64
+BANDS = 4               #a sketch is split into 4 bands of 16 bits for the near duplicate lookup
+MAX_DISTANCE = 3        #sketches that differ in at most this many bits count as near duplicates, must be < BANDS
+
+
+def content_hash(fields):
+    """
+    exact fingerprint of the indexed fields of a document (title, teaser and content).
+    """
+    digest = hashlib.sha1()
+    for name in ("title", "teaser", "content"):
+        digest.update(fields[name].encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def simhash(text):
+    """
+    64 bit SimHash of the words of text, weighted by how often they occur.
+    """
+    weights = [0] * SIMHASH_BITS
+    for word, count in Counter(re.findall(r"\w+", text.lower())).items():
+        value = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += count if value >> bit & 1 else -count
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+
+class SimHashIndex:
+    """
+    finds a stored sketch within MAX_DISTANCE bits of a new one.
+    two sketches that close share at least one of the BANDS bands exactly, so only
+    the urls in the same bucket of some band have to be compared.
+    """
+    def __init__(self):
+        self.sketches = {}      #url -> sketch
+        self.buckets = [{} for _ in range(BANDS)]       #per band: band value -> set of urls
+
+    def _bands(self, sketch):
+        width = SIMHASH_BITS // BANDS
+        mask = (1 << width) - 1
+        return [(sketch >> (band * width)) & mask for band in range(BANDS)]
+
+    def add(self, url, sketch):
+        self.remove(url)
+        self.sketches[url] = sketch
+        for buckets, value in zip(self.buckets, self._bands(sketch)):
+            buckets.setdefault(value, set()).add(url)
+
+    def remove(self, url):
+        sketch = self.sketches.pop(url, None)
+        if sketch is None:
+            return
+        for buckets, value in zip(self.buckets, self._bands(sketch)):
+            buckets[value].discard(url)
+            if not buckets[value]:
+                del buckets[value]
+
+    def find(self, sketch, exclude=()):
+        """
+        url of a near duplicate of sketch that is not in exclude, or None.
+        """
+        for buckets, value in zip(self.buckets, self._bands(sketch)):
+            for url in buckets.get(value, ()):
+                if url not in exclude and bin(self.sketches[url] ^ sketch).count("1") <= MAX_DISTANCE:
+                    return url
+        return None
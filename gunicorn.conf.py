@@ -0,0 +1,62 @@
+"""
+gunicorn settings for serving the search app with several worker processes, run from the repo:
+    gunicorn -c gunicorn.conf.py
+Every worker opens the index once after it is forked and only reads it. Pages posted to /index are
+handed to one writer process started by the master (writer_process.IndexWriterProcess), so the workers
+never wait for each other's MAIN_WRITELOCK. If the writer dies the master starts a new one and restarts the
+workers gracefully (SIGTERM) so they pick it up, until then /index answers 503.
+app.py run directly is the single process dev server.
+The workers and the writer share their metrics through a directory, so /metrics and /cache-stats
+report the totals of all of them whichever worker answers (see metrics.enable_multiprocess).
+SEARCH_WORKERS, SEARCH_BIND, SEARCH_INDEX_DIR, SEARCH_METRICS_DIR (default a temporary directory)
+and SEARCH_BACKEND (see app.py) configure it.
+"""
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = "AIandWEB2.app:app"
+pythonpath = f"{os.path.dirname(repo_dir)},{repo_dir}"      #the app is the AIandWEB2 package, the modules it uses are imported by their plain names
+chdir = repo_dir                            #relative index dirs are in the repo, like with the dev server
+bind = os.environ.get("SEARCH_BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("SEARCH_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+index_dir = os.environ.get("SEARCH_INDEX_DIR", "index")
+metrics_dir = os.environ.get("SEARCH_METRICS_DIR")
+temporary_metrics_dir = metrics_dir is None
+
+
+def on_starting(server):        #in the master, before any worker is forked
+    global metrics_dir
+    import metrics
+    import writer_process
+    if temporary_metrics_dir:
+        metrics_dir = tempfile.mkdtemp(prefix="search-metrics-")
+    else:
+        os.makedirs(metrics_dir, exist_ok=True)
+        metrics.clear_snapshots(metrics_dir)    #totals start over with the server
+    writer_process.start_shared_writer(index_dir, restarted=lambda: server.kill_workers(signal.SIGTERM),
+                                       batch_size=100, commit_interval=2.0, metrics_dir=metrics_dir)
+
+
+def post_fork(server, worker):  #in each new worker, the index is opened here and not inherited from the master
+    import metrics
+    import writer_process
+    from AIandWEB2.app import open_index
+    writer_process.forget_shared_writer()
+    metrics.enable_multiprocess(metrics_dir)
+    open_index()
+
+
+def child_exit(server, worker):     #in the master, a restarted worker's histograms and counters stay in the totals
+    import metrics
+    metrics.process_exited(metrics_dir, worker.pid)
+
+
+def on_exit(server):            #commit the pages that are still queued
+    import writer_process
+    writer_process.stop_shared_writer()
+    if temporary_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -1,84 +1,596 @@
 import os
-from whoosh.fields import Schema, TEXT, ID
-from whoosh.index import create_in, open_dir
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from whoosh.fields import Schema, TEXT, ID, STORED
+from whoosh.index import create_in, open_dir, exists_in
 from whoosh.writing import AsyncWriter
 from whoosh.qparser import QueryParser, MultifieldParser
-from bs4 import BeautifulSoup
+from whoosh.highlight import Highlighter, ContextFragmenter, PinpointFragmenter
+
+from extract import extract_page
+from fingerprint import SimHashIndex, content_hash, simhash
+from metrics import collected_samples, register_collector, timed
 
 schema = Schema(
     url = ID(stored=True, unique=True),      #unique identifier for the page
     title = TEXT(stored=True),               #title of the page
     teaser = TEXT(stored=True),              #teaser\snippet of the page
-    content = TEXT(stored= True)             #text content of the page
+    content = TEXT(stored= True, chars=True),    #text content of the page, with term positions so snippets don't re-analyze it
+    content_hash = ID(stored=True),          #fingerprint of the fields above, unchanged and duplicate pages are not written again
+    simhash = STORED()                       #near duplicate sketch as hex, only set by writers with near_duplicates
 
 )          
 
+SEARCH_FIELDS = ("title", "teaser", "content")
+FRAGMENT_CHARS = 200        #max length of one highlighted snippet
+FRAGMENT_SURROUND = 40      #context kept around the matched terms in a snippet
+FRAGMENT_TOP = 2            #snippets per hit
+HIGHLIGHT_CHARLIMIT = 20000 #for indexes without stored positions only the start of a page is re-analyzed for snippets
+
+#highlighting from the stored term positions, for indexes created before content had chars=True the text is re-tokenized
+_pinpoint_highlighter = Highlighter(fragmenter=PinpointFragmenter(maxchars=FRAGMENT_CHARS, surround=FRAGMENT_SURROUND, autotrim=True))
+_retokenizing_highlighter = Highlighter(fragmenter=ContextFragmenter(maxchars=FRAGMENT_CHARS, surround=FRAGMENT_SURROUND, charlimit=HIGHLIGHT_CHARLIMIT))
+REFRESH_INTERVAL = 1.0      #seconds between checks for commits made by other processes, e.g. the crawler
+
+_shared_indexes = {}        #absolute index dir -> _SharedIndex, one per process
+_shared_lock = threading.Lock()
+_parsers = {}               #(field names of the schema, search fields) -> MultifieldParser
+
 def initialize_index(index_dir="index"):
     """
     initialize the Whoosh index in the specified directory or creat the dir.
     """
     if not os.path.exists(index_dir):
         os.mkdir(index_dir)
+    if not exists_in(index_dir):        #a fresh or empty dir (the crawler creates it before calling this)
         print(f"Initializing new index at {index_dir}...")   
         return create_in(index_dir, schema)
     else:
         print(f"opening existing index at {index_dir}...")
-        return open_dir(index_dir)
+        ix = open_dir(index_dir)
+        missing = [name for name in schema.names() if name not in ix.schema]
+        if missing:                     #index created before these fields existed, old documents just don't have them
+            writer = ix.writer(timeout=30)
+            for name in missing:
+                writer.add_field(name, schema[name])
+            writer.commit()
+            print(f"added the fields {', '.join(missing)} to the index at {index_dir}")
+        return ix
    
+def document_fields(page):
+    """
+    title, teaser, content and content_hash fields of a document from its extracted Page.
+    the teaser is the meta description or the first 200 characters of the text.
+    """
+    fields = {
+        "title": page.title or "No Title",
+        "teaser": page.description or page.text[:200] + "...",
+        "content": page.content,
+    }
+    fields["content_hash"] = content_hash(fields)
+    return fields
+
+
+def _skip_reason(searcher, url, digest, batch_urls=None, batch_hashes=None):
+    """
+    why a document with the content_hash digest does not have to be written for url:
+    "unchanged" if url already has this content, "duplicate" if another url has it, otherwise None.
+    batch_urls, batch_hashes: url -> hash and hash -> url of the documents added but not committed yet,
+    the hash is None for urls whose document is deleted by the batch
+    """
+    if "content_hash" not in searcher.schema:
+        return None
+    batch_urls = batch_urls or {}
+    batch_hashes = batch_hashes or {}
+
+    if url in batch_urls:
+        current = batch_urls[url]
+    else:
+        stored = searcher.document(url=url)
+        current = stored.get("content_hash") if stored else None
+    if current == digest:
+        return "unchanged"
+
+    owner = batch_hashes.get(digest)
+    if owner is None:
+        for stored in searcher.documents(content_hash=digest):
+            if stored["url"] not in batch_urls:     #the committed content of urls changed in the batch is out of date
+                owner = stored["url"]
+                break
+    if owner is not None and owner != url:
+        return "duplicate"
+    return None
+
+
+class IndexBatchWriter:
+    """
+    Long lived writer that keeps the index open and commits in batches instead of once per document.
+    Commits after batch_size documents or commit_interval seconds, whatever comes first, and on close().
+    Documents are kept until the commit, one per url, so adding a url again before the commit replaces its document.
+    Use it as a context manager or call close() on shutdown so the last batch is not lost.
+    index_dir: Directory where the index is stored.
+    batch_size: number of documents per commit.
+    commit_interval: max seconds a document waits for its commit, None to only commit by batch_size.
+    near_duplicates: also skip pages whose SimHash is within a few bits of an indexed page, not only exact copies.
+    A failed commit drops the pending documents, commit_hooks run after each successful commit and
+    failure_hooks get the urls of the dropped documents.
+    Pages whose content_hash is unchanged or already indexed under another url are skipped, stats counts them.
+    A page skipped as a (near) duplicate still deletes the old document of its url.
+    """
+    def __init__(self, index_dir="index", batch_size=500, commit_interval=5.0, near_duplicates=False):
+        self.index_dir = index_dir
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.near_duplicates = near_duplicates
+        self.ix = initialize_index(index_dir)
+        self.stats = {"written": 0, "unchanged": 0, "duplicate": 0, "near_duplicate": 0}
+        self._searcher = None       #reads the fingerprints of the committed documents
+        self._pending = {}          #url -> fields of the documents added since the last commit, written by commit()
+        self._batch_urls = {}       #url -> content_hash of the same
+        self._batch_hashes = {}     #content_hash -> url of the same
+        self._sketches = None       #SimHashIndex of the committed documents, loaded when the first near duplicate check needs it
+        self._batch_sketches = SimHashIndex()   #sketches of the pending documents, added to _sketches after their commit
+        self.last_commit = time.monotonic()
+        self.lock = threading.RLock()
+        self.commit_hooks = []      #called after every successful commit, e.g. to make crawl state durable together with the index
+        self.failure_hooks = []     #called with the urls of the dropped documents after a failed commit
+        self._closed = threading.Event()
+        self._timer = None
+        if commit_interval:         #background thread for the time based commits, adds alone would never trigger them when traffic stops
+            self._timer = threading.Thread(target=self._commit_periodically, daemon=True)
+            self._timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, url, html=None, page=None):
+        """
+        Add or replace the document of url, it becomes searchable with the next commit.
+        Pass the extracted page instead of the html if it was already parsed, e.g. by the crawler.
+        Returns False if the page was skipped because it is unchanged or a duplicate (or failed), else True.
+        """
+        try:
+            fields = document_fields(page or extract_page(html, url))
+        except Exception as e:
+            print(f"Error indexing URL {url}: {e}")
+            return False
+        with self.lock:
+            if self._searcher is None:
+                self._searcher = self.ix.searcher()
+            elif not self._pending:         #no batch open, another process may have committed since
+                self._searcher = self._searcher.refresh()
+
+            reason = _skip_reason(self._searcher, url, fields["content_hash"], self._batch_urls, self._batch_hashes)
+            sketch = None
+            if reason is None and self.near_duplicates:
+                sketch = simhash(fields["content"])
+                if self._near_duplicate(url, sketch):
+                    reason = "near_duplicate"
+                else:
+                    fields["simhash"] = format(sketch, "016x")
+            if reason == "unchanged":
+                self.stats[reason] += 1
+                return False
+
+            self._forget_pending(url)
+            if reason is not None:      #a copy of another page, the document url had so far is out of date
+                self.stats[reason] += 1
+                if url in self._pending or self._searcher.document(url=url) is not None:
+                    self._pending[url] = None
+                    self._batch_urls[url] = None
+                return False
+
+            self._pending[url] = fields         #replaces a document of url added earlier in this batch
+            self._batch_urls[url] = fields["content_hash"]
+            self._batch_hashes[fields["content_hash"]] = url
+            if sketch is not None:
+                self._batch_sketches.add(url, sketch)
+            self.stats["written"] += 1
+            if len(self._pending) >= self.batch_size:
+                self.commit()
+            return True
+
+    def saved_writes(self):
+        """
+        number of pages that were not written because they were unchanged or duplicates.
+        """
+        return self.stats["unchanged"] + self.stats["duplicate"] + self.stats["near_duplicate"]
+
+    def _forget_pending(self, url):
+        """
+        drop the hash and sketch of the pending document of url before it is replaced or deleted.
+        """
+        digest = self._batch_urls.pop(url, None)
+        if digest is not None and self._batch_hashes.get(digest) == url:
+            del self._batch_hashes[digest]
+        self._batch_sketches.remove(url)
+
+    def _near_duplicate(self, url, sketch):
+        if self._sketches is None:
+            self._sketches = SimHashIndex()
+            for stored in self._searcher.all_stored_fields():
+                if stored.get("simhash"):
+                    self._sketches.add(stored["url"], int(stored["simhash"], 16))
+        stale = self._batch_urls.keys() | {url}    #committed sketches of urls changed in the batch are out of date
+        return (self._batch_sketches.find(sketch, exclude={url}) is not None
+                or self._sketches.find(sketch, exclude=stale) is not None)
+
+    def commit(self, optimize=False):
+        """
+        Write and commit the pending documents. optimize merges all segments into one.
+        The index writer is only opened here, so the MAIN_WRITELOCK is held as short as possible.
+        """
+        with self.lock:
+            committed = True
+            if not self._pending:
+                if optimize:
+                    with timed("commit"):
+                        self.ix.optimize()
+                    index_changed(self.index_dir)
+            else:
+                writer = None
+                dropped = list(self._pending)
+                try:
+                    with timed("commit"):
+                        writer = self.ix.writer(timeout=30)      #wait for other writers instead of failing right away
+                        for url, fields in self._pending.items():
+                            if fields is None:      #the page became a duplicate of another one
+                                writer.delete_by_term("url", url)
+                            else:
+                                writer.update_document(url=url, **fields)    #deletes the committed doc with the same unique url
+                        writer.commit(optimize=optimize)
+                    print(f"committed {len(self._pending)} documents. Index now contains {self.ix.doc_count()} documents.")
+                    if self._sketches is not None:
+                        for url, fields in self._pending.items():
+                            self._sketches.remove(url)
+                            if fields is not None and fields.get("simhash"):
+                                self._sketches.add(url, int(fields["simhash"], 16))
+                except Exception as e:
+                    print(f"Error committing to index {self.index_dir}: {e}")
+                    if writer is not None:
+                        writer.cancel()
+                    committed = False
+                self._pending = {}
+                self._batch_urls = {}
+                self._batch_hashes = {}
+                self._batch_sketches = SimHashIndex()
+                if self._searcher is not None:
+                    self._searcher = self._searcher.refresh()
+                index_changed(self.index_dir)
+            self.last_commit = time.monotonic()
+            if committed:
+                for hook in self.commit_hooks:
+                    hook()
+            else:
+                for hook in self.failure_hooks:
+                    hook(dropped)
+
+    def optimize(self):
+        """
+        Commit what is pending and merge the index segments into a single one.
+        """
+        self.commit(optimize=True)
+
+    def close(self):
+        """
+        Stop the commit timer and flush the last batch.
+        """
+        self._closed.set()
+        if self._timer is not None:
+            self._timer.join()
+        self.commit()
+        if self._searcher is not None:
+            self._searcher.close()
+            self._searcher = None
+
+    def _commit_periodically(self):
+        while not self._closed.wait(self.commit_interval / 2):
+            with self.lock:
+                if self._pending and time.monotonic() - self.last_commit >= self.commit_interval:
+                    self.commit()
+
+
 def add_to_index(index_dir="index", url=None, html=None):
     """
-    Add a document to the index.
+    Add a document to the index and commit it right away.
+    For more than a few documents use IndexBatchWriter, this opens the index and writes a new segment every call.
     index_dir: Directory where the index is stored.
     url: The URL of the page.
     html: The html content of the page.
     """
     try:
         ix = open_dir(index_dir)
+        fields = document_fields(extract_page(html, url))
+        with ix.searcher() as searcher:
+            reason = _skip_reason(searcher, url, fields["content_hash"])
+            indexed = searcher.document(url=url) is not None
+        if reason == "unchanged" or (reason is not None and not indexed):     #same content is in the index already, nothing to write
+            print(f"skipped {url}, {reason} content")
+            return
         writer = AsyncWriter(ix)    #create an asynchronous writer to add or modify documents in the indx
         writer.delete_by_term("url", url)   #delete already existing dosc to avoide duplicates
-        soup = BeautifulSoup(html, "html.parser")
-        title = soup.title.string.strip() if soup.title else "No Title"
-    
-        
-        meta_desc = soup.find("meta", {"name": "description"})      # extract a teaser/snippet use meta description or first 200 characters of text
-        teaser = (
-            meta_desc["content"].strip()
-            if meta_desc and meta_desc.get("content")
-            else ' '.join(soup.stripped_strings)[:200] + "..."
-        )
-        content = ' '.join([tag.get_text() for tag in soup.find_all(['p', 'div'])if tag.get_text()])       #extract the full content
-
-        writer.add_document(url=url, title=title, teaser=teaser, content=content)      #add the doc to the indx
-        writer.commit()
-        print(f"indexed {url}. Index now contains {ix.doc_count()} documents.")
+        if reason is None:
+            writer.add_document(url=url, **fields)      #add the doc to the indx
+        with timed("commit"):
+            writer.commit()
+        index_changed(index_dir)
+        if reason is not None:      #a copy of another page now, only its old document was removed
+            print(f"skipped {url}, {reason} content, removed its old document. Index now contains {ix.doc_count()} documents.")
+        else:
+            print(f"indexed {url}. Index now contains {ix.doc_count()} documents.")
     except Exception as e:
         print(f"Error indexing URL {url}: {e}")
 
 
-def search_index(query, index_dir="index"):
+class _SharedIndex:
     """
-    Search the index for a specific query.
+    Open index of one directory with a pool of searchers that are reused between queries.
+    Pooled searchers are refreshed when the index generation changed, a commit in this process marks it
+    changed right away and commits of other processes are noticed within REFRESH_INTERVAL seconds.
+    """
+    def __init__(self, index_dir):
+        with timed("open_dir"):
+            self.ix = open_dir(index_dir)
+        self.lock = threading.Lock()
+        self.idle = []              #searchers not used by any query right now
+        self.generation = self.ix.latest_generation()
+        self.checked = time.monotonic()
+        self.changed = False
+
+    def current_generation(self):
+        """
+        Latest known generation of the index, looked up again after a commit or REFRESH_INTERVAL.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.changed or now - self.checked >= REFRESH_INTERVAL:      #reading the TOC generation lists the dir, so not on every query
+                generation = self.ix.latest_generation()
+                if generation != self.generation:
+                    result_cache.clear()
+                self.generation = generation
+                self.checked = now
+                self.changed = False
+            return self.generation
+
+    def checkout(self):
+        generation = self.current_generation()
+        with self.lock:
+            searcher = self.idle.pop() if self.idle else None
+        if searcher is None:
+            with timed("open_dir"):
+                return self.ix.searcher()
+        if searcher.reader().generation() != generation:
+            with timed("open_dir"):
+                searcher = searcher.refresh()       #reuses the readers of the segments that did not change
+        return searcher
+
+    def checkin(self, searcher):
+        with self.lock:
+            self.idle.append(searcher)
+
+    def close(self):
+        with self.lock:
+            for searcher in self.idle:
+                searcher.close()
+            self.idle = []
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of search results, entries also expire after ttl seconds.
+    It is cleared whenever the index changes, see index_changed.
+    maxsize: Maximum number of cached result lists.
+    ttl: Seconds an entry stays valid, None to keep it until it is evicted.
+    """
+    def __init__(self, maxsize=256, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()    #key -> (expiry time, results), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Cached results for key or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:       #expired
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, results):
+        with self.lock:
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self.entries[key] = (expires, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Counters to size the cache with: hits, misses, hit_rate, evictions, size and maxsize.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+            }
+
+
+result_cache = ResultCache()        #shared by all searches of this process
+
+
+def _result_cache_samples():
+    stats = result_cache.stats()
+    return [
+        ("result_cache_hits_total", "counter", "Searches answered from the result cache.", stats["hits"]),
+        ("result_cache_misses_total", "counter", "Searches that missed the result cache.", stats["misses"]),
+        ("result_cache_evictions_total", "counter", "Entries evicted from the full result cache.", stats["evictions"]),
+        ("result_cache_size", "gauge", "Entries in the result cache.", stats["size"]),
+    ]
+
+
+register_collector(_result_cache_samples)
+
+
+def result_cache_stats():
+    """
+    result_cache.stats() added up over the caches of all processes that share their metrics (the gunicorn workers),
+    see metrics.enable_multiprocess. maxsize is the size of one cache.
+    """
+    samples = collected_samples()
+    hits = samples.get("result_cache_hits_total", 0)
+    misses = samples.get("result_cache_misses_total", 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "evictions": samples.get("result_cache_evictions_total", 0),
+        "size": samples.get("result_cache_size", 0),
+        "maxsize": result_cache.maxsize,
+    }
+
+
+def index_changed(index_dir="index"):
+    """
+    Tell the shared searchers of index_dir that a commit happened so the next query sees it
+    and drop the cached results that may be out of date now.
+    """
+    result_cache.clear()
+    shared = _shared_indexes.get(os.path.abspath(index_dir))
+    if shared is not None:
+        shared.changed = True
+
+
+def close_shared_index(index_dir="index"):
+    """
+    Close the pooled searchers of index_dir, the next query opens the index again.
+    """
+    with _shared_lock:
+        shared = _shared_indexes.pop(os.path.abspath(index_dir), None)
+    if shared is not None:
+        shared.close()
+
+
+def _shared_index(index_dir):
+    key = os.path.abspath(index_dir)
+    with _shared_lock:
+        shared = _shared_indexes.get(key)
+        if shared is None:
+            shared = _shared_indexes[key] = _SharedIndex(index_dir)
+        return shared
+
+
+def current_generation(index_dir="index"):
+    """
+    Latest known generation of the index in index_dir, commits of other processes are seen within REFRESH_INTERVAL.
+    """
+    return _shared_index(index_dir).current_generation()
+
+
+@contextmanager
+def shared_searcher(index_dir="index"):
+    """
+    Borrow an up to date searcher of index_dir from the process wide pool.
+    Searchers are not shared between threads at the same time, each query gets its own until it is done.
+    """
+    shared = _shared_index(index_dir)
+    searcher = shared.checkout()
+    try:
+        yield searcher
+    finally:
+        shared.checkin(searcher)
+
+
+def get_parser(schema, fields=SEARCH_FIELDS):
+    """
+    MultifieldParser for the fields of schema, built once per schema and reused.
+    """
+    key = (tuple(schema.names()), tuple(fields))
+    parser = _parsers.get(key)
+    if parser is None:
+        parser = _parsers[key] = MultifieldParser(list(fields), schema=schema)
+    return parser
+
+
+def search_page_index(query, index_dir="index", page=1, per_page=10):
+    """
+    Search the index for one page of results, only the hits of that page are highlighted.
+    Results are cached by query, page, per_page and index generation, see result_cache.
     query: The query string to search for.
     index_dir: Directory where the index is stored.
-    Returns a list of URLs matching the query.
+    page: Page number, starting at 1. Pages after the last one return the last page.
+    per_page: Number of results per page.
+    Returns a dict with the query, page, per_page, the total number of hits, pagecount and the results of the page.
     """
+    page = max(1, page)
+    per_page = max(1, per_page)
+    found = {"query": query, "page": page, "per_page": per_page, "total": 0, "pagecount": 0, "results": []}
     try:
-        ix = open_dir(index_dir)
-        with ix.searcher() as searcher:
-            parser = MultifieldParser(["title", "teaser", "content"], schema=ix.schema)
-            parsed_query = parser.parse(query)
-            results = searcher.search(parsed_query)
-            return [
-                {
-                    "url": result["url"],
-                    "title": result["title"],
-                    "teaser": result.highlights("content") or result["teaser"]
-                }
-                for result in results
-            ]
+        generation = current_generation(index_dir)
+        key = (os.path.abspath(index_dir), generation, " ".join(query.split()), page, per_page)     #whitespace does not change the query, case does (AND/OR)
+        cached = result_cache.get(key)
+        if cached is not None:
+            return dict(cached, results=list(cached["results"]))
+
+        with shared_searcher(index_dir) as searcher:
+            with timed("query_parse"):
+                parsed_query = get_parser(searcher.schema).parse(query)
+            with timed("search"):
+                hits = searcher.search_page(parsed_query, page, pagelen=per_page, terms=True)    #terms=True lets the highlighter use stored positions
+            if hits.total:
+                hits.results.highlighter = (
+                    _pinpoint_highlighter if searcher.schema["content"].supports("characters") else _retokenizing_highlighter
+                )
+                found.update(page=hits.pagenum, total=hits.total, pagecount=hits.pagecount)
+                with timed("highlight"):
+                    found["results"] = [
+                        {
+                            "url": result["url"],
+                            "title": result["title"],
+                            "teaser": result.highlights("content", top=FRAGMENT_TOP) or result["teaser"]
+                        }
+                        for result in hits
+                    ]
+        result_cache.put(key, found)
+        return dict(found, results=list(found["results"]))
     except Exception as e:
         print(f"Error searching index {e}")
-        return []
+        return dict(found, total=0, pagecount=0, results=[])
+
+
+def search_index(query, index_dir="index", limit=10):
+    """
+    Search the index for a specific query.
+    query: The query string to search for.
+    index_dir: Directory where the index is stored.
+    limit: Maximum number of results.
+    Returns a list of URLs matching the query.
+    """
+    return search_page_index(query, index_dir, page=1, per_page=limit)["results"]
     
 #just for testing
 if __name__ == "__main__":
@@ -0,0 +1,392 @@
+"""
+Compact in-memory inverted index, a fast alternative search backend for the hot working set.
+Documents get integer ids, every posting list is a sorted array of doc ids stored as delta + varint
+compressed bytes with a parallel array of term frequencies, queries intersect the posting lists
+and score the matches with BM25, both vectorized with NumPy.
+An index can be snapshotted to one file that is memory-mapped on load, so startup doesn't re-read Whoosh.
+
+Queries are plain words that all have to match (like the default AND of the Whoosh parser),
+the query syntax of Whoosh (OR, NOT, phrases, field:term) is not supported.
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+import numpy as np
+from markupsafe import escape
+from whoosh.analysis import STOP_WORDS
+from whoosh.index import open_dir
+
+from index_builder_whoosh import current_generation
+from metrics import timed
+
+TOKEN_RE = re.compile(r"\w+")
+K1 = 1.2            #BM25 term frequency saturation
+B = 0.75            #BM25 document length normalization
+
+MAGIC = b"AIWMEM01"
+HEADER = struct.Struct("<8s6Q")     #magic, docs, terms, postings, compressed bytes, json bytes, index generation
+
+REBUILD_INTERVAL = 10.0     #min seconds between two rebuilds after commits, searches use the previous index meanwhile
+DECODED_BYTES = 32 * 2 ** 20    #max bytes of decoded posting lists kept per index, the least recently used are dropped
+
+_memory_indexes = {}        #absolute index dir -> _MemoryBackend, one per process
+_memory_lock = threading.Lock()
+
+
+def tokenize(text):
+    """
+    lowercased words of text without stop words and single characters, like the Whoosh StandardAnalyzer.
+    """
+    return [word for word in TOKEN_RE.findall(text.lower()) if len(word) > 1 and word not in STOP_WORDS]
+
+
+def encode_postings(doc_ids):
+    """
+    sorted doc ids as varint encoded gaps, 7 bits per byte and the high bit set on all but the last byte of a number.
+    """
+    out = bytearray()
+    previous = 0
+    for doc_id in doc_ids:
+        gap = doc_id - previous
+        previous = doc_id
+        while gap >= 0x80:
+            out.append((gap & 0x7F) | 0x80)
+            gap >>= 7
+        out.append(gap)
+    return bytes(out)
+
+
+def decode_postings(data):
+    """
+    inverse of encode_postings for a uint8 array, without a Python loop over the numbers.
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)                  #last byte of every number
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    number = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = 7 * (np.arange(len(data)) - starts[number])
+    gaps = np.add.reduceat((data & 0x7F).astype(np.int64) << shift, starts)
+    return np.cumsum(gaps)
+
+
+def intersect(small, large):
+    """
+    doc ids of the sorted array small that are also in the sorted array large, with their positions in large.
+    every id of the shorter list is binary searched in the longer one (np.searchsorted), which like
+    galloping costs O(m log n) instead of walking both lists.
+    """
+    positions = np.searchsorted(large, small)
+    positions[positions == len(large)] = 0
+    found = large[positions] == small if len(large) else np.zeros(len(small), dtype=bool)
+    return small[found], positions[found]
+
+
+class MemoryIndex:
+    """
+    Immutable in-memory index, build it with build() or from_whoosh() and save()/load() it as a snapshot.
+    """
+    def __init__(self, urls, titles, teasers, vocabulary, doc_lengths, df, post_offsets, tf_offsets, tfs, postings,
+                 generation=None):
+        self.urls = urls
+        self.titles = titles
+        self.teasers = teasers
+        self.terms = {term: term_id for term_id, term in enumerate(vocabulary)}
+        self.vocabulary = vocabulary
+        self.doc_lengths = doc_lengths          #float32 per doc, number of tokens
+        self.df = df                            #uint32 per term, number of docs with the term
+        self.post_offsets = post_offsets        #uint64 per term + 1, byte range of the term in postings
+        self.tf_offsets = tf_offsets            #uint64 per term + 1, range of the term in tfs
+        self.tfs = tfs                          #uint32 term frequencies, in the order of the doc ids
+        self.postings = postings                #uint8 compressed doc ids of all terms
+        self.generation = generation            #Whoosh index generation the index was built from
+        self.avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        self._decoded = OrderedDict()           #term id -> decoded doc ids of the recently queried terms, least recently used first
+        self._decoded_bytes = 0
+        self._decoded_lock = threading.Lock()
+
+    @classmethod
+    def build(cls, documents, generation=None):
+        """
+        build from dicts with url, title, teaser and content. title and teaser words are indexed with the content.
+        """
+        urls, titles, teasers, lengths = [], [], [], []
+        term_postings = defaultdict(list)       #term -> [(doc id, tf)] in doc id order
+        for doc_id, document in enumerate(documents):
+            urls.append(document["url"])
+            titles.append(document.get("title") or "")
+            teasers.append(document.get("teaser") or "")
+            tokens = tokenize(" ".join((titles[-1], teasers[-1], document.get("content") or "")))
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_postings[term].append((doc_id, tf))
+
+        vocabulary = sorted(term_postings)
+        df = np.array([len(term_postings[term]) for term in vocabulary], dtype=np.uint32)
+        chunks, tfs = [], []
+        for term in vocabulary:
+            doc_ids, frequencies = zip(*term_postings[term])
+            chunks.append(encode_postings(doc_ids))
+            tfs.extend(frequencies)
+        post_offsets = np.zeros(len(vocabulary) + 1, dtype=np.uint64)
+        post_offsets[1:] = np.cumsum([len(chunk) for chunk in chunks])
+        tf_offsets = np.zeros(len(vocabulary) + 1, dtype=np.uint64)
+        tf_offsets[1:] = np.cumsum(df)
+        return cls(
+            urls, titles, teasers, vocabulary,
+            np.array(lengths, dtype=np.float32), df, post_offsets, tf_offsets,
+            np.array(tfs, dtype=np.uint32), np.frombuffer(b"".join(chunks), dtype=np.uint8),
+            generation,
+        )
+
+    @classmethod
+    def from_whoosh(cls, index_dir="index"):
+        """
+        build from the stored fields of the Whoosh index in index_dir.
+        """
+        ix = open_dir(index_dir)
+        with ix.searcher() as searcher:
+            generation = searcher.reader().generation()
+            if generation is None:      #nothing committed yet, the empty reader has no generation
+                generation = -1
+            return cls.build(list(searcher.all_stored_fields()), generation=generation)
+
+    def save(self, path):
+        """
+        write a snapshot that load() can memory-map. arrays are 8 byte aligned so they can be used in place.
+        """
+        meta = json.dumps({
+            "urls": self.urls, "titles": self.titles, "teasers": self.teasers, "vocabulary": self.vocabulary,
+        }).encode("utf-8")
+        generation = -1 if self.generation is None else self.generation
+        #a temp file of our own, other processes may be writing a snapshot of the same index at the same time
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                        dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(HEADER.pack(MAGIC, len(self.urls), len(self.vocabulary), len(self.tfs), len(self.postings),
+                                       len(meta), generation + 1))
+                for array in (self.doc_lengths, self.df, self.post_offsets, self.tf_offsets, self.tfs, self.postings):
+                    file.write(array.tobytes())
+                    file.write(b"\0" * (-array.nbytes % 8))
+                file.write(meta)
+            os.replace(tmp_path, path)          #readers never see a half written snapshot
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        open a snapshot written by save(). the arrays are views on the memory-mapped file, not copies.
+        """
+        with open(path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, docs, terms, postings, compressed, meta_size, generation = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a memory index snapshot")
+
+        offset = HEADER.size
+        arrays = []
+        for dtype, count in ((np.float32, docs), (np.uint32, terms), (np.uint64, terms + 1), (np.uint64, terms + 1),
+                             (np.uint32, postings), (np.uint8, compressed)):
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            arrays.append(array)
+            offset += array.nbytes + (-array.nbytes % 8)
+        if len(data) != offset + meta_size:
+            raise ValueError(f"{path} is truncated or not a complete snapshot")
+        meta = json.loads(data[offset:offset + meta_size].decode("utf-8"))
+        return cls(meta["urls"], meta["titles"], meta["teasers"], meta["vocabulary"], *arrays,
+                   generation=generation - 1 if generation else None)
+
+    def _doc_ids(self, term_id):
+        """
+        decoded doc ids of a term. the lists of frequent query terms are cached, up to DECODED_BYTES
+        so the int64 copies don't undo the compression of the postings.
+        """
+        with self._decoded_lock:
+            doc_ids = self._decoded.get(term_id)
+            if doc_ids is not None:
+                self._decoded.move_to_end(term_id)
+                return doc_ids
+        start, end = int(self.post_offsets[term_id]), int(self.post_offsets[term_id + 1])
+        doc_ids = decode_postings(self.postings[start:end])
+        if doc_ids.nbytes > DECODED_BYTES:
+            return doc_ids
+        with self._decoded_lock:
+            if term_id not in self._decoded:        #another query may have decoded it meanwhile
+                self._decoded[term_id] = doc_ids
+                self._decoded_bytes += doc_ids.nbytes
+                while self._decoded_bytes > DECODED_BYTES:
+                    _, dropped = self._decoded.popitem(last=False)
+                    self._decoded_bytes -= dropped.nbytes
+        return doc_ids
+
+    def _term_frequencies(self, term_id):
+        return self.tfs[int(self.tf_offsets[term_id]):int(self.tf_offsets[term_id + 1])]
+
+    def search(self, query, page=1, per_page=10):
+        """
+        one page of the documents that contain every word of query, best BM25 score first.
+        returns the same dict as index_builder_whoosh.search_page_index.
+        """
+        page = max(1, page)
+        per_page = max(1, per_page)
+        found = {"query": query, "page": page, "per_page": per_page, "total": 0, "pagecount": 0, "results": []}
+        words = sorted(set(tokenize(query)))
+        if not words or any(word not in self.terms for word in words):
+            return found
+
+        with timed("search"):
+            term_ids = sorted((self.terms[word] for word in words), key=lambda term_id: self.df[term_id])
+            matches = self._doc_ids(term_ids[0])        #start from the shortest posting list
+            for term_id in term_ids[1:]:
+                matches, _ = intersect(matches, self._doc_ids(term_id))
+                if not len(matches):
+                    return found
+
+            scores = np.zeros(len(matches), dtype=np.float64)
+            lengths = self.doc_lengths[matches]
+            norm = K1 * (1 - B + B * lengths / (self.avg_length or 1.0))
+            for term_id in term_ids:
+                _, positions = intersect(matches, self._doc_ids(term_id))
+                tf = self._term_frequencies(term_id)[positions].astype(np.float64)
+                df = float(self.df[term_id])
+                idf = np.log(1 + (len(self.urls) - df + 0.5) / (df + 0.5))
+                scores += idf * tf * (K1 + 1) / (tf + norm)
+
+            total = len(matches)
+            pagecount = -(-total // per_page)
+            page = min(page, pagecount)
+            top = (page - 1) * per_page + per_page
+            if top < total:     #only sort the best `top` scores
+                best = np.argpartition(-scores, top - 1)[:top]
+            else:
+                best = np.arange(total)
+            best = best[np.lexsort((best, -scores[best]))][(page - 1) * per_page:]     #ties in doc id order
+
+        with timed("highlight"):
+            found.update(page=page, total=total, pagecount=pagecount)
+            found["results"] = [
+                {
+                    "url": self.urls[doc_id],
+                    "title": self.titles[doc_id],
+                    "teaser": _highlight(self.teasers[doc_id], words),
+                }
+                for doc_id in matches[best]
+            ]
+        return found
+
+
+def _highlight(teaser, words):
+    """
+    html escaped teaser with the query words in <b class="match">, like the Whoosh snippets.
+    """
+    pattern = re.compile(r"\b(" + "|".join(re.escape(word) for word in words) + r")\b", re.IGNORECASE)
+    pieces = pattern.split(teaser)      #the raw text and the matched words alternate, matches at the odd positions
+    return "".join(
+        f'<b class="match">{escape(piece)}</b>' if position % 2 else str(escape(piece))
+        for position, piece in enumerate(pieces)
+    )     #matched on the raw text, so words like amp or lt never match inside an escaped entity
+
+
+def snapshot_path(index_dir="index"):
+    return os.path.abspath(index_dir) + ".memory"
+
+
+class _MemoryBackend:
+    """
+    MemoryIndex of one Whoosh index dir, kept up to date with the commits to it.
+    The first search loads the snapshot next to the index dir if it matches the index generation, otherwise
+    (also when it can't be read) builds the index from Whoosh and writes a new snapshot.
+    After a commit the index is rebuilt the same way on a background thread, at most once per REBUILD_INTERVAL,
+    searches keep using the previous index until the new one is ready.
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.path = snapshot_path(index_dir)
+        self.index = None
+        self.lock = threading.Lock()
+        self.rebuilding = False
+        self.last_rebuild = 0.0
+
+    def get(self):
+        generation = current_generation(self.index_dir)
+        if self.index is None:
+            with self.lock:
+                if self.index is None:      #nothing to serve yet, the first search has to wait for it
+                    self.index = self._open(generation)
+                    self.last_rebuild = time.monotonic()
+            return self.index
+
+        stale = self.index.generation is None or self.index.generation < generation     #a rebuild can read a newer commit than the cached generation
+        if stale:
+            with self.lock:
+                if not self.rebuilding and time.monotonic() - self.last_rebuild >= REBUILD_INTERVAL:
+                    self.rebuilding = True
+                    threading.Thread(target=self._rebuild, args=(generation,), daemon=True).start()
+        return self.index
+
+    def _rebuild(self, generation):
+        try:
+            self.index = self._open(generation)
+        except Exception as e:
+            print(f"Error rebuilding memory index of {self.index_dir}: {e}")
+        finally:
+            with self.lock:
+                self.rebuilding = False
+                self.last_rebuild = time.monotonic()
+
+    def _open(self, generation):
+        with timed("open_dir"):
+            memory_index = None
+            if os.path.exists(self.path):
+                try:
+                    memory_index = MemoryIndex.load(self.path)
+                except Exception as e:
+                    print(f"Error loading memory index snapshot {self.path}, rebuilding it: {e}")
+            if memory_index is None or memory_index.generation != generation:
+                memory_index = MemoryIndex.from_whoosh(self.index_dir)
+                try:
+                    memory_index.save(self.path)
+                except Exception as e:
+                    print(f"Error saving memory index snapshot {self.path}: {e}")
+            return memory_index
+
+
+def get_memory_index(index_dir="index"):
+    """
+    process wide MemoryIndex of the Whoosh index in index_dir, see _MemoryBackend for when it is rebuilt.
+    """
+    key = os.path.abspath(index_dir)
+    with _memory_lock:
+        backend = _memory_indexes.get(key)
+        if backend is None:
+            backend = _memory_indexes[key] = _MemoryBackend(index_dir)
+    return backend.get()
+
+
+def search_memory_page(query, index_dir="index", page=1, per_page=10):
+    """
+    search_page_index on the in-memory backend, same arguments and result dict.
+    """
+    try:
+        return get_memory_index(index_dir).search(query, page=page, per_page=per_page)
+    except Exception as e:
+        print(f"Error searching memory index {e}")
+        return {"query": query, "page": max(1, page), "per_page": max(1, per_page), "total": 0, "pagecount": 0, "results": []}
+
+
+def search_memory_index(query, index_dir="index", limit=10):
+    """
+    search_index on the in-memory backend, returns a list of url, title and teaser dicts.
+    """
+    return search_memory_page(query, index_dir, page=1, per_page=limit)["results"]
@@ -0,0 +1,238 @@
+"""
+Latency histograms for the hot paths of searching, indexing and crawling,
+exported in the Prometheus text format (served on /metrics by app.py, or by serve() in the crawler).
+
+With several processes (the gunicorn workers and the index writer process, see gunicorn.conf.py) every process
+calls enable_multiprocess with the same directory and writes its samples there about once a second.
+An export then adds up the histograms and samples of all processes, so it is the same whichever worker serves it.
+"""
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "searchengine"
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGES = {
+    "open_dir": "Seconds spent opening the index or opening/refreshing a searcher.",
+    "query_parse": "Seconds spent parsing a query string.",
+    "search": "Seconds spent running a query.",
+    "highlight": "Seconds spent building the snippets of a result page.",
+    "render": "Seconds spent rendering a template.",
+    "fetch": "Seconds spent downloading a page in the crawler.",
+    "parse": "Seconds spent extracting the text and links of a page.",
+    "commit": "Seconds spent committing documents to the index.",
+}
+
+
+class Histogram:
+    """
+    cumulative Prometheus style histogram of durations in seconds.
+    """
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def state(self):
+        """
+        bucket counts, sum and count, the part of the histogram that is added up across processes.
+        """
+        with self.lock:
+            return {"counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    def render(self, state=None):
+        state = state or self.state()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for bound, count in zip(self.buckets, state["counts"]):
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {state["count"]}')
+        lines.append(f"{self.name}_sum {state['sum']}")
+        lines.append(f"{self.name}_count {state['count']}")
+        return lines
+
+
+histograms = {stage: Histogram(f"{PREFIX}_{stage}_seconds", help) for stage, help in STAGES.items()}
+_collectors = []        #functions returning (name, type, help, value) tuples, e.g. the result cache counters
+_snapshot_dir = None    #set by enable_multiprocess
+SNAPSHOT_INTERVAL = 1.0
+
+
+def observe(stage, seconds):
+    """
+    record one duration of stage (a key of STAGES).
+    """
+    histograms[stage].observe(seconds)
+
+
+@contextmanager
+def timed(stage):
+    """
+    time the body of the with block into the histogram of stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def register_collector(collector):
+    """
+    add a function that returns extra (name, type, help, value) samples for every export.
+    """
+    _collectors.append(collector)
+
+
+def _local():
+    """
+    histogram states and collected (name, type, help, value) samples of this process.
+    """
+    samples = [list(sample) for collector in _collectors for sample in collector()]
+    return {"histograms": {stage: histogram.state() for stage, histogram in histograms.items()}, "samples": samples}
+
+
+def enable_multiprocess(directory, interval=SNAPSHOT_INTERVAL):
+    """
+    share the samples of this process with the other processes writing to directory, call it after forking.
+    """
+    global _snapshot_dir
+    _snapshot_dir = directory
+    _write_snapshot()
+    threading.Thread(target=_write_periodically, args=(interval,), daemon=True).start()
+    atexit.register(_write_snapshot)        #the last samples of a process that exits
+
+
+def _write_periodically(interval):
+    while True:
+        time.sleep(interval)
+        _write_snapshot()
+
+
+def _write_snapshot():
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=_snapshot_dir)
+        with os.fdopen(fd, "w") as file:
+            json.dump(_local(), file)
+        os.replace(tmp_path, os.path.join(_snapshot_dir, f"{os.getpid()}.json"))
+    except Exception as e:
+        print(f"Error writing metrics snapshot to {_snapshot_dir}: {e}")
+
+
+def clear_snapshots(directory):
+    """
+    remove the snapshots of an earlier run from directory, call it before the processes start.
+    """
+    for name in os.listdir(directory):
+        if name.endswith(".json") or name.endswith(".tmp"):
+            os.remove(os.path.join(directory, name))
+
+
+def process_exited(directory, pid):
+    """
+    keep the histograms and counters of a process that exited in the totals, but not its gauges.
+    without this the totals would drop whenever a worker is restarted.
+    """
+    try:
+        os.replace(os.path.join(directory, f"{pid}.json"), os.path.join(directory, f"dead-{pid}-{time.time_ns()}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def _aggregate():
+    """
+    histogram states and samples added up over the snapshots of all processes, this one included.
+    """
+    _write_snapshot()
+    for _ in range(3):      #a snapshot renamed by process_exited while we read is found under its new name on the next try
+        totals = {"histograms": {}, "samples": []}
+        sample_index = {}
+        try:
+            for name in sorted(os.listdir(_snapshot_dir)):
+                if not name.endswith(".json"):
+                    continue
+                with open(os.path.join(_snapshot_dir, name)) as file:
+                    snapshot = json.load(file)
+                exited = name.startswith("dead-")
+                for stage, state in snapshot["histograms"].items():
+                    total = totals["histograms"].setdefault(stage, {"counts": [0] * len(state["counts"]), "sum": 0.0, "count": 0})
+                    total["counts"] = [a + b for a, b in zip(total["counts"], state["counts"])]
+                    total["sum"] += state["sum"]
+                    total["count"] += state["count"]
+                for sample_name, kind, help, value in snapshot["samples"]:
+                    if exited and kind == "gauge":
+                        continue
+                    if sample_name not in sample_index:
+                        sample_index[sample_name] = len(totals["samples"])
+                        totals["samples"].append([sample_name, kind, help, 0])
+                    totals["samples"][sample_index[sample_name]][3] += value
+            return totals
+        except FileNotFoundError:
+            continue
+    return _local()
+
+
+def _collect():
+    return _aggregate() if _snapshot_dir is not None else _local()
+
+
+def collected_samples():
+    """
+    name -> value of the collected samples, added up over all processes with enable_multiprocess.
+    """
+    return {name: value for name, _, _, value in _collect()["samples"]}
+
+
+def render_prometheus():
+    """
+    all histograms and collected samples in the Prometheus text exposition format.
+    """
+    collected = _collect()
+    lines = []
+    for stage, histogram in histograms.items():
+        lines.extend(histogram.render(collected["histograms"].get(stage)))
+    for name, kind, help, value in collected["samples"]:
+        lines.extend([f"# HELP {PREFIX}_{name} {help}", f"# TYPE {PREFIX}_{name} {kind}", f"{PREFIX}_{name} {value}"])
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """
+    serve /metrics on a background thread, for processes without the flask app like the crawler.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,237 @@
+"""
+Staged crawl pipeline: fetch on threads -> parse on a process pool -> one index writer.
+The stages are joined by bounded queues so a slow stage holds back the ones before it instead of
+piling up pages in memory, and every stage reports its throughput and the depth of its input queue.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from extract import extract_page
+from crawl_state import NOT_MODIFIED
+from metrics import observe
+
+_DONE = object()        #end of stream marker passed down the queues
+
+
+def _timed_extract(html, url):
+    """
+    extract_page in a parse process, returns the page and the seconds it took.
+    """
+    start = time.perf_counter()
+    page = extract_page(html, url)
+    return page, time.perf_counter() - start
+
+
+def _parse_context():
+    """
+    start the parse processes from a fork server where there is one: the pool starts them while the
+    fetch threads and the index writer's commit timer run, and forking a process with threads can copy held locks.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return None         #windows only spawns
+
+
+class StageStats:
+    """
+    counters of one pipeline stage.
+    name: stage name in the reports
+    feed: the queue the stage reads from, for the queue depth
+    """
+    def __init__(self, name, feed=None):
+        self.name = name
+        self.feed = feed
+        self.items = 0
+        self.busy = 0.0         #seconds spent working on items, summed over the workers of the stage
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.items += 1
+            self.busy += seconds
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        with self.lock:
+            items, busy = self.items, self.busy
+        depth = f"  queue {self.feed.qsize():>4}/{self.feed.maxsize}" if self.feed is not None else ""
+        per_item = busy / items * 1000 if items else 0.0
+        return f"{self.name:<6} {items:>6} items  {items / elapsed:8.1f}/s  {per_item:8.2f} ms/item{depth}"
+
+
+class CrawlPipeline:
+    """
+    Crawl with fetching, parsing and index writing as separate stages.
+    crawler: the WebCrawler that provides the limits, robots.txt rules, polite fetching and the index writer
+    parse_workers: number of parse processes, defaults to the number of cores
+    queue_size: capacity of the queues between the stages
+    report_interval: seconds between stage reports, None for only the final one
+    """
+    def __init__(self, crawler, parse_workers=None, queue_size=64, report_interval=5.0):
+        self.crawler = crawler
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+
+        self.fetched = queue.Queue(maxsize=queue_size)              #(url, depth, html) waiting for a parse process
+        self.parsing = queue.Queue(maxsize=self.parse_workers * 2)  #parse futures in submit order, bounds the pool's own queue
+        self.parsed = queue.Queue(maxsize=queue_size)               #(url, depth, page) waiting for the index writer
+        self.finished = queue.Queue()                               #(url, depth, links or None, changed) back to the frontier
+
+        self.stats = [
+            StageStats("fetch"),
+            StageStats("parse", self.fetched),
+            StageStats("index", self.parsed),
+        ]
+        self._stopped = threading.Event()
+
+    def run(self, URL=None):
+        """
+        crawl breadth first from URL (default the crawler's baseURL) with the crawler's max_depth/max_pages rules.
+        """
+        crawler = self.crawler
+        frontier, queued = crawler.start_frontier(URL or crawler.baseURL)
+        outstanding = 0         #urls somewhere in the pipeline, each one comes back exactly once on self.finished
+        capacity = crawler.workers + 2 * self.queue_size + self.parse_workers * 2
+
+        stages = [
+            threading.Thread(target=self._dispatch_parsing, daemon=True),
+            threading.Thread(target=self._collect_parsing, daemon=True),
+            threading.Thread(target=self._write, daemon=True),
+        ]
+        if self.report_interval:
+            stages.append(threading.Thread(target=self._report_periodically, daemon=True))
+
+        fetchers = ThreadPoolExecutor(max_workers=crawler.workers)
+        self.parsers = self._start_parsers()
+        try:
+            with fetchers:
+                for stage in stages:
+                    stage.start()
+
+                while True:
+                    while frontier and outstanding < capacity and crawler.page_count + outstanding < crawler.max_pages:
+                        url, depth = frontier.popleft()
+                        if not crawler.is_allowed(url):
+                            print(f"skipping disallowed url: {url}")
+                            crawler.page_failed(url)
+                            continue
+                        print(f"crawling {url} in depth {depth}")
+                        fetchers.submit(self._fetch, url, depth)
+                        outstanding += 1
+
+                    if not outstanding:
+                        break
+
+                    url, depth, links, changed = self.finished.get()
+                    outstanding -= 1
+                    if links is None:       #failed to fetch, parse or index
+                        crawler.page_failed(url)
+                        continue
+                    crawler.page_done(url, links, changed)
+                    crawler.follow_links(links, depth, frontier, queued)
+
+                self.fetched.put(_DONE)     #drain the stages in order
+                for stage in stages[:3]:
+                    stage.join()
+                self._stopped.set()
+        finally:
+            self.parsers.shutdown()      #the current pool, _submit_parsing replaces a broken one
+
+        crawler.finish_crawl()
+        print(self.report())
+
+    def report(self):
+        """
+        one line per stage with its items, throughput, time per item and input queue depth.
+        """
+        return "\n".join(stats.report() for stats in self.stats)
+
+    def _fetch(self, url, depth):
+        start = time.perf_counter()
+        try:
+            html = self.crawler.polite_fetch(url)
+        except Exception as e:
+            print(f"Error fetching {url}: {e}")
+            html = None
+        self.stats[0].record(time.perf_counter() - start)
+        if html is NOT_MODIFIED:        #unchanged since the last crawl, skips parsing and indexing
+            self.finished.put((url, depth, self.crawler.unchanged_links(url), False))
+        elif html:
+            self.fetched.put((url, depth, html))        #blocks while the parse stage is behind
+        else:
+            self.finished.put((url, depth, None, False))
+
+    def _dispatch_parsing(self):
+        while True:
+            item = self.fetched.get()
+            if item is _DONE:
+                self.parsing.put(_DONE)
+                return
+            url, depth, html = item
+            try:
+                future = self._submit_parsing(html, url)
+            except Exception as e:      #the url still has to come back or run() waits for it forever
+                print(f"Error parsing {url}: {e}")
+                self.finished.put((url, depth, None, False))
+                continue
+            self.parsing.put((url, depth, future))
+
+    def _start_parsers(self):
+        return ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=_parse_context())
+
+    def _submit_parsing(self, html, url):
+        """
+        parse future of html, a pool that is broken because one of its processes died (killed for memory,
+        a crashing parser) is replaced by a new one. the futures of the broken pool fail in _collect_parsing.
+        """
+        try:
+            return self.parsers.submit(_timed_extract, html, url)
+        except BrokenProcessPool as e:
+            print(f"parse process died ({e}), starting new parse processes")
+            self.parsers.shutdown(wait=False)
+            self.parsers = self._start_parsers()
+            return self.parsers.submit(_timed_extract, html, url)
+
+    def _collect_parsing(self):
+        while True:
+            item = self.parsing.get()
+            if item is _DONE:
+                self.parsed.put(_DONE)
+                return
+            url, depth, future = item
+            try:
+                page, seconds = future.result()
+            except Exception as e:
+                print(f"Error parsing {url}: {e}")
+                self.finished.put((url, depth, None, False))
+                continue
+            self.stats[1].record(seconds)
+            observe("parse", seconds)       #measured in the parse process, whose own histograms are never exported
+            self.parsed.put((url, depth, page))         #blocks while the index writer is behind
+
+    def _write(self):
+        while True:
+            item = self.parsed.get()
+            if item is _DONE:
+                return
+            url, depth, page = item
+            start = time.perf_counter()
+            try:
+                self.crawler.writer.add(url, page=page)
+            except Exception as e:      #e.g. a LockError, the url still has to come back or run() waits for it forever
+                print(f"Error indexing {url}: {e}")
+                self.finished.put((url, depth, None, False))
+                continue
+            self.stats[2].record(time.perf_counter() - start)
+            self.finished.put((url, depth, page.links, True))
+
+    def _report_periodically(self):
+        while not self._stopped.wait(self.report_interval):
+            print(self.report())
@@ -0,0 +1,56 @@
+from crawl_state import CrawlState
+
+START = "http://x/"
+
+
+def test_a_new_run_starts_at_the_url(tmp_path):
+    state = CrawlState(str(tmp_path / "state.db"))
+    assert state.begin(START) == ([(START, 0)], set(), {START})
+
+
+def test_an_interrupted_run_resumes_with_its_committed_frontier(tmp_path):
+    path = str(tmp_path / "state.db")
+    state = CrawlState(path)
+    state.begin(START)
+    state.page_fetched(START, ["http://x/a", "http://x/b"], etag='"1"')
+    state.enqueue(["http://x/a", "http://x/b"], 1)
+    state.commit()
+    state.page_fetched("http://x/a", [])     #not committed, the index never got this page
+    state.close()
+
+    state = CrawlState(path)
+    pending, done, seen = state.begin(START)
+    assert pending == [("http://x/a", 1), ("http://x/b", 1)]
+    assert done == {START}
+    assert seen == {START, "http://x/a", "http://x/b"}
+    assert state.validators(START) == ('"1"', None)
+    assert state.stored_links(START) == ["http://x/a", "http://x/b"]
+
+
+def test_a_finished_run_is_not_resumed(tmp_path):
+    path = str(tmp_path / "state.db")
+    state = CrawlState(path)
+    state.begin(START)
+    state.enqueue(["http://x/a"], 1)
+    state.finish_run()
+    state.commit()
+    state.close()
+
+    assert CrawlState(path).begin(START) == ([(START, 0)], set(), {START})
+
+
+def test_a_rollback_forgets_what_the_failed_index_commit_did_not_store(tmp_path):
+    path = str(tmp_path / "state.db")
+    state = CrawlState(path)
+    state.begin(START)
+    state.page_fetched(START, ["http://x/a"], etag='"1"')
+    state.enqueue(["http://x/a"], 1)
+    state.commit()
+    state.page_fetched("http://x/a", [], etag='"2"')
+    state.rollback()
+    state.commit()
+    state.close()
+
+    state = CrawlState(path)
+    assert state.begin(START) == ([("http://x/a", 1)], {START}, {START, "http://x/a"})
+    assert state.validators("http://x/a") == (None, None)
@@ -0,0 +1,53 @@
+import pytest
+
+import extract
+from extract import Page, extract_page
+
+BACKENDS = ["html.parser"] + (["lxml"] if extract.etree is not None else [])
+
+
+@pytest.fixture(params=BACKENDS, autouse=True)
+def backend(request, monkeypatch):
+    if request.param == "html.parser":
+        monkeypatch.setattr(extract, "etree", None)
+    return request.param
+
+
+def test_page_fields():
+    page = extract_page(
+        '<html><head><title> Home </title><meta name="Description" content="About us">'
+        '<style>p { color: red }</style><script>var x = "<p>no</p>";</script></head>'
+        '<body><h1>Welcome</h1><div>intro <p>nested</p> tail</div>'
+        '<a href="/a">A</a> <a href="b.html">B</a> <a href="/a">again</a> <a href="">empty</a></body></html>',
+        "http://x/dir/index.html",
+    )
+    assert page == Page(
+        title="Home",
+        description="About us",
+        text="Home Welcome intro nested tail A B again empty",
+        content="intro nested tail",
+        links=["http://x/a", "http://x/dir/b.html"],
+    )
+
+
+def test_an_empty_page():
+    assert extract_page("  ") == Page(title=None, description=None, text="", content="", links=[])
+
+
+def test_block_tags_end_an_open_paragraph():
+    page = extract_page("<p>unclosed para<ul><li>item</li></ul><span>after</span>")
+    assert page.content == "unclosed para"
+    assert page.text == "unclosed para item after"
+    assert extract_page("<p>one<p>two<div>three</div>four").content == "one two three"
+    assert extract_page("<div>a<p>b<table><tr><td>c</td></tr></table>d</div>e").content == "a b c d"
+
+
+def test_end_tags_end_the_tags_left_open_inside():
+    assert extract_page("<div><p>x</div>y").content == "x"
+    assert extract_page("<table><tr><td><p>x</td></tr></table>y").content == "x"
+    assert extract_page("<p>x<span>s<div>d</div>t</span>u").content == "x s d t u"
+    assert extract_page("<div>x</p>y</div>z").content == "xy"        #a stray end tag is dropped
+
+
+def test_entities_do_not_split_the_text():
+    assert extract_page("<p>The &ldquo;raw&rdquo; API &amp; more</p>").content == "The “raw” API & more"
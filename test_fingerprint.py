@@ -0,0 +1,36 @@
+from fingerprint import SimHashIndex, content_hash, simhash
+
+
+def fields(content):
+    return {"title": "t", "teaser": "", "content": content}
+
+
+def test_content_hash_changes_with_any_field():
+    assert content_hash(fields("a")) == content_hash(fields("a"))
+    assert content_hash(fields("a")) != content_hash(fields("b"))
+    assert content_hash({"title": "ab", "teaser": "", "content": ""}) != content_hash({"title": "a", "teaser": "b", "content": ""})
+
+
+def test_similar_texts_have_close_sketches():
+    text = " ".join(f"word{number}" for number in range(300))
+    assert bin(simhash(text) ^ simhash(text + " extra")).count("1") <= 3
+    assert bin(simhash(text) ^ simhash("something else entirely")).count("1") > 3
+
+
+def test_find_matches_within_max_distance_only():
+    index = SimHashIndex()
+    index.add("http://x/a", 0b1011 << 20)
+    assert index.find(0b1011 << 20) == "http://x/a"
+    assert index.find((0b1011 << 20) ^ 0b111) == "http://x/a"        #3 bits apart
+    assert index.find((0b1011 << 20) ^ 0b1111) is None               #4 bits apart
+
+
+def test_find_skips_excluded_and_removed_urls():
+    index = SimHashIndex()
+    index.add("http://x/a", 12345)
+    assert index.find(12345, exclude={"http://x/a"}) is None
+    index.add("http://x/a", 99999 << 40)     #adding again replaces the old sketch
+    assert index.find(12345) is None
+    index.remove("http://x/a")
+    assert index.find(99999 << 40) is None
+    assert index.buckets == [{} for _ in index.buckets]
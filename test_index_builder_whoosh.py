@@ -0,0 +1,225 @@
+import time
+
+from whoosh.fields import ID, TEXT, Schema
+from whoosh.highlight import Highlighter
+from whoosh.index import LockError, create_in, open_dir
+
+import index_builder_whoosh
+from index_builder_whoosh import (
+    IndexBatchWriter, ResultCache, _skip_reason, add_to_index, close_shared_index, search_page_index,
+)
+
+
+def page(title, body):
+    return f"<html><head><title>{title}</title></head><body><p>{body}</p></body></html>"
+
+
+def urls_matching(index_dir, word):
+    ix = open_dir(index_dir)
+    with ix.searcher() as searcher:
+        return sorted(hit["url"] for hit in searcher.documents() if word in hit["content"].split())
+
+
+def test_adding_a_url_twice_in_one_batch_keeps_the_last_document(tmp_path):
+    with IndexBatchWriter(str(tmp_path), commit_interval=None) as writer:
+        writer.add("http://x/a", page("A", "alpha words here"))
+        writer.add("http://x/a", page("A", "gamma words here"))
+
+    assert open_dir(str(tmp_path)).doc_count() == 1
+    assert urls_matching(str(tmp_path), "alpha") == []
+    assert urls_matching(str(tmp_path), "gamma") == ["http://x/a"]
+
+
+def test_adding_a_committed_url_again_replaces_it(tmp_path):
+    with IndexBatchWriter(str(tmp_path), commit_interval=None) as writer:
+        writer.add("http://x/a", page("A", "alpha words here"))
+        writer.commit()
+        writer.add("http://x/a", page("A", "gamma words here"))
+
+    assert open_dir(str(tmp_path)).doc_count() == 1
+    assert urls_matching(str(tmp_path), "gamma") == ["http://x/a"]
+
+
+def test_skip_reason(tmp_path):
+    with IndexBatchWriter(str(tmp_path), commit_interval=None) as writer:
+        writer.add("http://x/a", page("A", "alpha words here"))
+    ix = open_dir(str(tmp_path))
+    with ix.searcher() as searcher:
+        digest = searcher.document(url="http://x/a")["content_hash"]
+        assert _skip_reason(searcher, "http://x/a", digest) == "unchanged"
+        assert _skip_reason(searcher, "http://x/b", digest) == "duplicate"
+        assert _skip_reason(searcher, "http://x/b", "other") is None
+        #a changed in the batch: its committed content no longer makes b a duplicate
+        assert _skip_reason(searcher, "http://x/b", digest, {"http://x/a": "other"}, {"other": "http://x/a"}) is None
+        assert _skip_reason(searcher, "http://x/a", digest, {"http://x/a": None}) is None
+
+
+def test_a_page_that_became_a_duplicate_loses_its_old_document(tmp_path):
+    with IndexBatchWriter(str(tmp_path), commit_interval=None) as writer:
+        writer.add("http://x/a", page("Same", "alpha words here"))
+        writer.add("http://x/b", page("B", "bravo words here"))
+        writer.commit()
+        assert not writer.add("http://x/b", page("Same", "alpha words here"))
+        assert writer.stats["duplicate"] == 1
+
+    assert urls_matching(str(tmp_path), "bravo") == []
+    assert urls_matching(str(tmp_path), "alpha") == ["http://x/a"]
+
+
+def test_content_replaced_in_the_batch_is_no_duplicate(tmp_path):
+    with IndexBatchWriter(str(tmp_path), commit_interval=None) as writer:
+        writer.add("http://x/a", page("Same", "alpha words here"))
+        writer.add("http://x/a", page("Same", "gamma words here"))
+        assert writer.add("http://x/b", page("Same", "alpha words here"))
+        writer.commit()
+        writer.add("http://x/a", page("Same", "delta words here"))
+        assert writer.add("http://x/c", page("Same", "gamma words here"))
+
+    assert urls_matching(str(tmp_path), "alpha") == ["http://x/b"]
+    assert urls_matching(str(tmp_path), "gamma") == ["http://x/c"]
+
+
+def long_page(extra):
+    words = " ".join(f"word{number}" for number in range(300))
+    return page("Long", f"{words} {extra}")
+
+
+def test_near_duplicates(tmp_path):
+    with IndexBatchWriter(str(tmp_path), commit_interval=None, near_duplicates=True) as writer:
+        assert writer.add("http://x/a", long_page("one"))
+        assert not writer.add("http://x/b", long_page("two"))
+        assert writer.stats["near_duplicate"] == 1
+
+
+def locked(**kwargs):
+    raise LockError()
+
+
+def test_a_failed_commit_leaves_no_sketch_behind(tmp_path, monkeypatch):
+    with IndexBatchWriter(str(tmp_path), commit_interval=None, near_duplicates=True) as writer:
+        writer.add("http://x/a", long_page("one"))
+        with monkeypatch.context() as patch:
+            patch.setattr(writer.ix, "writer", locked)
+            writer.commit()
+        assert writer.add("http://x/b", long_page("two"))
+
+    assert urls_matching(str(tmp_path), "two") == ["http://x/b"]
+
+
+def test_a_failed_commit_reports_the_dropped_urls(tmp_path, monkeypatch):
+    committed, dropped = [], []
+    with IndexBatchWriter(str(tmp_path), commit_interval=None) as writer:
+        writer.commit_hooks.append(lambda: committed.append(True))
+        writer.failure_hooks.append(dropped.extend)
+        writer.add("http://x/a", page("A", "alpha words here"))
+        writer.add("http://x/b", page("B", "bravo words here"))
+        with monkeypatch.context() as patch:
+            patch.setattr(writer.ix, "writer", locked)
+            writer.commit()
+        assert (sorted(dropped), committed) == (["http://x/a", "http://x/b"], [])
+        writer.add("http://x/c", page("C", "charlie words here"))
+
+    assert committed == [True]
+    assert open_dir(str(tmp_path)).doc_count() == 1
+
+
+def test_result_cache_evicts_the_least_recently_used():
+    cache = ResultCache(maxsize=2, ttl=None)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1          #b is the least recently used now
+    cache.put("c", 3)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert cache.stats() == {"hits": 3, "misses": 1, "hit_rate": 0.75, "evictions": 1, "size": 2, "maxsize": 2}
+
+
+def test_result_cache_entries_expire():
+    cache = ResultCache(ttl=0.05)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def cached_search(index_dir, word):
+    return sorted(hit["url"] for hit in search_page_index(word, index_dir)["results"])
+
+
+def test_commits_invalidate_cached_results(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_builder_whoosh, "result_cache", ResultCache())
+    index_dir = str(tmp_path)
+    with IndexBatchWriter(index_dir, commit_interval=None) as writer:
+        writer.add("http://x/a", page("A", "alpha words here"))
+        writer.commit()
+        assert cached_search(index_dir, "alpha") == ["http://x/a"]
+        assert cached_search(index_dir, "alpha") == ["http://x/a"]
+        assert index_builder_whoosh.result_cache.stats()["hits"] == 1
+
+        writer.add("http://x/b", page("B", "alpha again here"))
+        writer.commit()
+        assert index_builder_whoosh.result_cache.stats()["size"] == 0
+        assert cached_search(index_dir, "alpha") == ["http://x/a", "http://x/b"]
+
+    add_to_index(index_dir, "http://x/c", page("C", "alpha once more"))
+    assert index_builder_whoosh.result_cache.stats()["size"] == 0
+    assert cached_search(index_dir, "alpha") == ["http://x/a", "http://x/b", "http://x/c"]
+    close_shared_index(index_dir)
+
+
+def test_search_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_builder_whoosh, "result_cache", ResultCache())
+    index_dir = str(tmp_path)
+    with IndexBatchWriter(index_dir, commit_interval=None) as writer:
+        for number in range(5):
+            writer.add(f"http://x/{number}", page(f"Page {number}", f"common words number{number}"))
+
+    pages = [search_page_index("common", index_dir, page=number, per_page=2) for number in (1, 2, 3)]
+    assert [(found["page"], found["total"], found["pagecount"], len(found["results"])) for found in pages] == [
+        (1, 5, 3, 2), (2, 5, 3, 2), (3, 5, 3, 1),
+    ]
+    assert sorted(result["url"] for found in pages for result in found["results"]) == [f"http://x/{n}" for n in range(5)]
+
+    past_the_end = search_page_index("common", index_dir, page=9, per_page=2)
+    assert (past_the_end["page"], past_the_end["results"]) == (3, pages[2]["results"])
+    assert search_page_index("common", index_dir, page=0, per_page=0)["page"] == 1
+    assert search_page_index("missing", index_dir)["total"] == 0
+    close_shared_index(index_dir)
+
+
+class RecordingHighlighter(Highlighter):
+    def __init__(self, name, used, fragmenter):
+        super().__init__(fragmenter=fragmenter)
+        self.name = name
+        self.used = used
+
+    def highlight_hit(self, *args, **kwargs):
+        self.used.append(self.name)
+        return super().highlight_hit(*args, **kwargs)
+
+
+def highlighters_used(monkeypatch, index_dir):
+    used = []
+    monkeypatch.setattr(index_builder_whoosh, "result_cache", ResultCache())
+    for name in ("_pinpoint_highlighter", "_retokenizing_highlighter"):
+        fragmenter = getattr(index_builder_whoosh, name).fragmenter
+        monkeypatch.setattr(index_builder_whoosh, name, RecordingHighlighter(name, used, fragmenter))
+    found = search_page_index("alpha", index_dir)
+    close_shared_index(index_dir)
+    assert '<b class="match term0">alpha</b>' in found["results"][0]["teaser"]
+    return set(used)
+
+
+def test_snippets_come_from_stored_positions(tmp_path, monkeypatch):
+    with IndexBatchWriter(str(tmp_path), commit_interval=None) as writer:
+        writer.add("http://x/a", page("A", "alpha words here"))
+    assert highlighters_used(monkeypatch, str(tmp_path)) == {"_pinpoint_highlighter"}
+
+
+def test_indexes_without_positions_are_retokenized(tmp_path, monkeypatch):
+    old_schema = Schema(url=ID(stored=True, unique=True), title=TEXT(stored=True), teaser=TEXT(stored=True),
+                        content=TEXT(stored=True))      #content before it had chars=True
+    writer = create_in(str(tmp_path), old_schema).writer()
+    writer.add_document(url="http://x/a", title="A", teaser="A", content="alpha words here")
+    writer.commit()
+    assert highlighters_used(monkeypatch, str(tmp_path)) == {"_retokenizing_highlighter"}
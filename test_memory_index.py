@@ -0,0 +1,142 @@
+import threading
+import time
+
+import numpy as np
+
+import memory_index
+from index_builder_whoosh import IndexBatchWriter, add_to_index, initialize_index
+from memory_index import MemoryIndex, decode_postings, encode_postings, get_memory_index, intersect, search_memory_page
+
+
+def test_postings_round_trip():
+    for doc_ids in ([], [0], [1, 2, 3], [5, 127, 128, 300, 16384, 2 ** 40]):
+        data = np.frombuffer(encode_postings(doc_ids), dtype=np.uint8)
+        assert decode_postings(data).tolist() == doc_ids
+
+
+def test_gaps_below_128_take_one_byte():
+    assert len(encode_postings(range(0, 1000, 100))) == 10
+
+
+def test_intersect():
+    small = np.array([1, 4, 9, 20])
+    large = np.array([0, 1, 2, 3, 9, 10, 30])
+    found, positions = intersect(small, large)
+    assert found.tolist() == [1, 9]
+    assert large[positions].tolist() == [1, 9]
+    assert intersect(small, np.array([], dtype=np.int64))[0].tolist() == []
+    assert intersect(np.array([], dtype=np.int64), large)[0].tolist() == []
+
+
+def documents():
+    return [
+        {"url": "http://x/a", "title": "A", "teaser": "alpha", "content": "alpha beta beta beta"},
+        {"url": "http://x/b", "title": "B", "teaser": "alpha", "content": "alpha beta and a lot of other words here"},
+        {"url": "http://x/c", "title": "C", "teaser": "gamma", "content": "gamma beta"},
+    ]
+
+
+def test_search_matches_all_words_best_first():
+    index = MemoryIndex.build(documents())
+    found = index.search("beta alpha")
+    assert found["total"] == 2
+    assert [result["url"] for result in found["results"]] == ["http://x/a", "http://x/b"]
+    assert index.search("alpha missing")["total"] == 0
+
+
+def test_search_pages():
+    index = MemoryIndex.build(documents())
+    found = index.search("beta", page=2, per_page=2)
+    assert (found["page"], found["pagecount"], found["total"], len(found["results"])) == (2, 2, 3, 1)
+    assert index.search("beta", page=9, per_page=2)["page"] == 2
+
+
+def test_decoded_postings_stay_within_their_budget(monkeypatch):
+    monkeypatch.setattr(memory_index, "DECODED_BYTES", 16)
+    index = MemoryIndex.build(documents())
+    expected = {query: MemoryIndex.build(documents()).search(query) for query in ["alpha", "beta", "gamma", "lot", "words"]}
+    for query, found in expected.items():
+        assert index.search(query) == found
+        assert index._decoded_bytes == sum(doc_ids.nbytes for doc_ids in index._decoded.values()) <= 16
+    assert list(index._decoded) == [index.terms["lot"], index.terms["words"]]      #alpha and gamma were dropped, least recently used first
+    assert index.search("beta") == expected["beta"]     #3 docs, 24 bytes: decoded for the query but never cached
+    assert list(index._decoded) == [index.terms["lot"], index.terms["words"]]
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "index.memory")
+    MemoryIndex.build(documents(), generation=7).save(path)
+    loaded = MemoryIndex.load(path)
+    assert loaded.generation == 7
+    assert loaded.search("beta") == MemoryIndex.build(documents()).search("beta")
+
+
+def test_concurrent_saves_do_not_collide(tmp_path):
+    path = str(tmp_path / "index.memory")
+    index = MemoryIndex.build(documents(), generation=1)
+    errors = []
+
+    def save():
+        try:
+            for _ in range(20):
+                index.save(path)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert MemoryIndex.load(path).search("beta")["total"] == 3
+    assert sorted(file.name for file in tmp_path.iterdir()) == ["index.memory"]
+
+
+def whoosh_index(index_dir, *words):
+    with IndexBatchWriter(index_dir, commit_interval=None) as writer:
+        for number, word in enumerate(words):
+            writer.add(f"http://x/{word}", f"<html><title>{word}</title><body><p>{word} text {number}</p></body></html>")
+
+
+def test_a_broken_snapshot_is_rebuilt(tmp_path):
+    index_dir = str(tmp_path / "index")
+    whoosh_index(index_dir, "alpha")
+    get_memory_index(index_dir)
+    path = memory_index.snapshot_path(index_dir)
+    with open(path, "r+b") as file:
+        file.truncate(100)
+    memory_index._memory_indexes.clear()
+
+    assert search_memory_page("alpha", index_dir)["total"] == 1
+
+
+def test_commits_are_picked_up_in_the_background(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory_index, "REBUILD_INTERVAL", 0)
+    index_dir = str(tmp_path / "index")
+    whoosh_index(index_dir, "alpha")
+    assert search_memory_page("gamma", index_dir)["total"] == 0
+
+    whoosh_index(index_dir, "gamma")
+    deadline = time.monotonic() + 10
+    while search_memory_page("gamma", index_dir)["total"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert search_memory_page("gamma", index_dir)["total"] == 1
+
+
+def test_an_index_that_starts_empty_picks_up_its_first_commit(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory_index, "REBUILD_INTERVAL", 0)
+    index_dir = str(tmp_path / "index")
+    initialize_index(index_dir)
+    assert search_memory_page("alpha", index_dir)["total"] == 0
+
+    add_to_index(index_dir, "http://x/alpha", "<html><title>alpha</title><body><p>alpha text</p></body></html>")
+    deadline = time.monotonic() + 10
+    while search_memory_page("alpha", index_dir)["total"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert search_memory_page("alpha", index_dir)["total"] == 1
+
+
+def test_highlight_escapes_the_teaser_and_marks_whole_words():
+    assert memory_index._highlight("x & lt <b>", ["amp", "lt"]) == 'x &amp; <b class="match">lt</b> &lt;b&gt;'
+    assert memory_index._highlight("Alpha alphabet", ["alpha"]) == '<b class="match">Alpha</b> alphabet'
@@ -0,0 +1,30 @@
+import json
+
+import metrics
+
+
+def snapshot(directory, name, commits, hits, size):
+    histograms = {stage: {"counts": [0] * len(metrics.BUCKETS), "sum": 0.0, "count": 0} for stage in metrics.STAGES}
+    histograms["commit"] = {"counts": [commits] * len(metrics.BUCKETS), "sum": 0.5 * commits, "count": commits}
+    samples = [["result_cache_hits_total", "counter", "hits", hits], ["result_cache_size", "gauge", "size", size]]
+    (directory / name).write_text(json.dumps({"histograms": histograms, "samples": samples}))
+
+
+def test_samples_of_all_processes_are_added_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "_snapshot_dir", str(tmp_path))
+    monkeypatch.setattr(metrics, "_collectors", [])
+    monkeypatch.setattr(metrics, "histograms", {stage: metrics.Histogram(f"searchengine_{stage}_seconds", help)
+                                                for stage, help in metrics.STAGES.items()})
+    snapshot(tmp_path, "101.json", commits=2, hits=5, size=3)
+    snapshot(tmp_path, "102.json", commits=1, hits=7, size=4)
+    metrics.process_exited(str(tmp_path), 102)       #counters of an exited process stay, its gauges don't
+
+    assert metrics.collected_samples() == {"result_cache_hits_total": 12, "result_cache_size": 3}
+    assert "searchengine_commit_seconds_count 3" in metrics.render_prometheus().splitlines()
+
+
+def test_clear_snapshots(tmp_path):
+    snapshot(tmp_path, "101.json", commits=1, hits=1, size=1)
+    metrics.process_exited(str(tmp_path), 101)
+    metrics.clear_snapshots(str(tmp_path))
+    assert list(tmp_path.iterdir()) == []
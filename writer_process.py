@@ -0,0 +1,174 @@
+"""
+Single index writer for multi-process serving.
+The gunicorn master starts one IndexWriterProcess before it forks the workers (see gunicorn.conf.py),
+the workers inherit it and only put the posted pages on its queue, so the MAIN_WRITELOCK is taken by
+one process and the N worker processes only ever read the index.
+"""
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import threading
+import time
+
+import metrics
+
+shared_writer = None        #the IndexWriterProcess of the gunicorn master, inherited by its workers
+RESTART_DELAY = 1.0         #seconds the watchdog waits before it replaces a dead writer, so a writer that can't start doesn't spin
+
+
+class WriterUnavailable(RuntimeError):
+    """
+    the writer process is not running (it died and is being replaced), pages can't be queued.
+    """
+
+
+def _write_loop(pages, ready, index_dir, batch_size, commit_interval, metrics_dir):
+    from index_builder_whoosh import IndexBatchWriter
+    if metrics_dir:     #the parse and commit timings of the posted pages are only measured here
+        metrics.enable_multiprocess(metrics_dir)
+    for signum in (signal.SIGINT, signal.SIGTERM):     #ctrl-c or a stop of the whole process group: the master closes us once the queue is drained
+        signal.signal(signum, signal.SIG_IGN)
+    master = os.getppid()
+    writer = IndexBatchWriter(index_dir, batch_size=batch_size, commit_interval=commit_interval)
+    ready.set()
+    try:
+        while True:
+            try:
+                page = pages.get(timeout=1)
+            except queue.Empty:
+                if os.getppid() != master:      #the master was killed without closing us
+                    break
+                continue
+            if page is None:
+                break
+            writer.add(*page)
+    finally:
+        writer.close()
+
+
+class IndexWriterProcess:
+    """
+    IndexBatchWriter running in its own process, fed through a queue by any number of other processes.
+    index_dir: Directory where the index is stored.
+    batch_size, commit_interval: passed on to the IndexBatchWriter.
+    queue_size: pages waiting for the writer before add() blocks.
+    metrics_dir: directory to share the writer's metrics with the workers, see metrics.enable_multiprocess.
+    """
+    def __init__(self, index_dir="index", batch_size=100, commit_interval=2.0, queue_size=1000, metrics_dir=None):
+        self.pages = multiprocessing.Queue(queue_size)
+        self.ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=_write_loop,
+            args=(self.pages, self.ready, index_dir, batch_size, commit_interval, metrics_dir),
+            name="index-writer",
+            daemon=True,
+        )
+
+    def start(self, timeout=60):
+        """
+        start the writer and wait until it created or opened the index, so workers can open it right away.
+        """
+        self.process.start()
+        if not self.ready.wait(timeout):
+            self.process.terminate()
+            raise RuntimeError("index writer process did not start")
+        return self
+
+    def alive(self):
+        """
+        True while the writer process runs. Unlike Process.is_alive() it works in every process that
+        inherited the writer, not only in its parent, and also after gunicorn reaped the exited process
+        (is_alive() keeps saying True then): the sentinel becomes readable when the process ends.
+        """
+        return not multiprocessing.connection.wait([self.process.sentinel], 0)
+
+    def add(self, url, html, timeout=5):
+        """
+        queue a page for the writer, it becomes searchable with the writer's next commit.
+        raises WriterUnavailable if the writer process died and queue.Full if it is more than queue_size
+        pages behind for timeout seconds.
+        """
+        if not self.alive():        #nobody would ever read the page from the queue
+            raise WriterUnavailable("index writer process is not running")
+        self.pages.put((url, html), timeout=timeout)
+
+    def close(self, timeout=30):
+        """
+        let the writer index what is queued, commit and exit.
+        """
+        if not self.alive():        #its pid may already be reaped and reused, don't signal it
+            print("index writer process is not running, the pages still queued for it are lost")
+            _forget(self.process)
+            return
+        try:
+            self.pages.put(None, timeout=timeout)
+        except queue.Full:
+            print("index writer queue is full, stopping it without waiting for the queued pages")
+        self.process.join(timeout)
+        if self.alive():
+            self.process.terminate()
+
+
+def start_shared_writer(index_dir="index", restarted=None, **kwargs):
+    """
+    start the process wide writer, call it in the gunicorn master before the workers are forked.
+    A watchdog thread replaces the writer whenever its process dies (killed for memory, a crash). The workers
+    forked before that still hold the dead writer and answer /index with WriterUnavailable, restarted() is
+    called after every replacement to restart them, so the new workers inherit the new writer.
+    kwargs are passed on to IndexWriterProcess.
+    """
+    global shared_writer
+    shared_writer = IndexWriterProcess(index_dir, **kwargs).start()
+    threading.Thread(target=_watch, args=(index_dir, kwargs, restarted), name="index-writer-watchdog", daemon=True).start()
+    return shared_writer
+
+
+def _watch(index_dir, kwargs, restarted):
+    global shared_writer
+    while True:
+        writer = shared_writer
+        if writer is None:
+            return
+        multiprocessing.connection.wait([writer.process.sentinel])
+        if shared_writer is not writer:     #stopped by stop_shared_writer
+            return
+        _forget(writer.process)
+        print(f"index writer process {writer.process.pid} died, starting a new one")
+        time.sleep(RESTART_DELAY)
+        if shared_writer is not writer:
+            return
+        try:
+            shared_writer = IndexWriterProcess(index_dir, **kwargs).start()
+        except Exception as e:
+            print(f"Error starting the index writer process: {e}")
+            continue        #the failed writer's sentinel is ready as well, so it is tried again
+        if restarted is not None:
+            restarted()
+
+
+def _forget(process):
+    """
+    drop process from the children that multiprocessing terminates and joins when this process exits.
+    Fragile: the set is private to multiprocessing (process._children, it resets it the same way in the
+    processes it starts itself), there is no public way to disown a child. Without it a gunicorn worker
+    fails joining the writer it did not start, and the master signals the pid of a writer that gunicorn
+    already reaped, which may belong to another process by then.
+    """
+    getattr(multiprocessing.process, "_children", set()).discard(process)
+
+
+def forget_shared_writer():
+    """
+    call in every process forked by the gunicorn master, the writer is a child of the master only.
+    """
+    if shared_writer is not None:
+        _forget(shared_writer.process)
+
+
+def stop_shared_writer():
+    global shared_writer
+    writer, shared_writer = shared_writer, None     #first, so the watchdog doesn't replace the writer we stop
+    if writer is not None:
+        writer.close()